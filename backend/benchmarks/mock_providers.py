@@ -0,0 +1,216 @@
+"""Local stand-ins for the Airtable meta, Notion search/blocks and HubSpot CRM v3 APIs.
+
+Datasets are generated deterministically from a MockConfig. Every request can be delayed
+and a share of them answered with 429 + Retry-After, so loaders can be measured against
+realistic pagination and throttling without touching the real providers.
+
+Run standalone with `python -m benchmarks.mock_providers --port 8900`, then point the
+backend at it with HTTP_UPSTREAM_OVERRIDES (see http_client.py).
+"""
+import random
+import asyncio
+import argparse
+import datetime
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+PROVIDER_HOSTS = ('api.airtable.com', 'api.notion.com', 'api.hubapi.com')
+HUBSPOT_TYPES = ('contacts', 'deals', 'companies', 'tickets')
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@dataclass
+class MockConfig:
+    airtable_bases: int = 50
+    airtable_tables_per_base: int = 10
+    notion_pages: int = 200
+    # Child pages per Notion page; the rest of the tree hangs off the first pages
+    notion_fanout: int = 5
+    notion_blocks_per_page: int = 20
+    hubspot_objects_per_type: int = 1000
+    page_size: int = 100
+    latency_ms: float = 20
+    latency_jitter_ms: float = 5
+    # Share of requests answered with 429, and the Retry-After sent with them
+    throttle_rate: float = 0.0
+    retry_after: float = 0.1
+    seed: int = 0
+
+
+def _iso(seconds):
+    return (EPOCH + datetime.timedelta(seconds=seconds)).isoformat().replace('+00:00', 'Z')
+
+
+def _cursor_page(rows, cursor, limit):
+    start = int(cursor or 0)
+    end = start + limit
+    return rows[start:end], (str(end) if end < len(rows) else None)
+
+
+class MockDatasets:
+    def __init__(self, config):
+        self.bases = [{'id': f'app{i:06d}', 'name': f'Base {i}', 'permissionLevel': 'create'} for i in range(config.airtable_bases)]
+        self.tables = {
+            base['id']: [
+                {'id': f'tbl{i:06d}{j:03d}', 'name': f'Table {j}', 'primaryFieldId': 'fld0', 'fields': []}
+                for j in range(config.airtable_tables_per_base)
+            ]
+            for i, base in enumerate(self.bases)
+        }
+
+        self.notion_pages = []
+        self.notion_blocks = {}
+        for i in range(config.notion_pages):
+            page_id = f'page-{i:06d}'
+            parent_index = (i - 1) // config.notion_fanout if i else None
+            parent = {'type': 'workspace', 'workspace': True} if parent_index is None else {'type': 'page_id', 'page_id': f'page-{parent_index:06d}'}
+            self.notion_pages.append({
+                'object': 'page',
+                'id': page_id,
+                'parent': parent,
+                'created_time': _iso(i * 60),
+                'last_edited_time': _iso((config.notion_pages - i) * 3600),
+                'url': f'https://www.notion.so/{page_id}',
+                'properties': {'title': {'title': [{'text': {'content': f'Page {i}'}}]}},
+            })
+            children = [
+                {'id': f'page-{child:06d}', 'type': 'child_page', 'child_page': {'title': f'Page {child}'}, 'has_children': True}
+                for child in range(i * config.notion_fanout + 1, min((i + 1) * config.notion_fanout + 1, config.notion_pages))
+            ]
+            children += [
+                {'id': f'block-{i:06d}-{j:04d}', 'type': 'paragraph', 'has_children': False}
+                for j in range(config.notion_blocks_per_page)
+            ]
+            self.notion_blocks[page_id] = children
+        # Search returns the most recently edited first
+        self.notion_pages.sort(key=lambda page: page['last_edited_time'], reverse=True)
+
+        self.hubspot = {}
+        now_ms = int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+        start_ms = int(EPOCH.timestamp() * 1000)
+        for object_type in HUBSPOT_TYPES:
+            count = config.hubspot_objects_per_type
+            step = max((now_ms - start_ms) // max(count, 1), 1)
+            rows = []
+            for i in range(count):
+                modified_ms = start_ms + i * step
+                modified = datetime.datetime.fromtimestamp(modified_ms / 1000, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+                rows.append({
+                    'id': f'{i + 1}',
+                    'properties': {
+                        'firstname': f'First{i}', 'lastname': f'Last{i}', 'email': f'user{i}@example.com',
+                        'dealname': f'Deal {i}', 'name': f'Company {i}', 'subject': f'Ticket {i}',
+                        'hs_object_id': f'{i + 1}',
+                    },
+                    'createdAt': modified,
+                    'updatedAt': modified,
+                    'archived': False,
+                    '_modified_ms': modified_ms,
+                })
+            self.hubspot[object_type] = rows
+
+
+def _public(row):
+    return {key: value for key, value in row.items() if not key.startswith('_')}
+
+
+def create_mock_app(config=None):
+    """ASGI app serving all three provider APIs from one MockConfig."""
+    config = config or MockConfig()
+    data = MockDatasets(config)
+    rng = random.Random(config.seed)
+    app = FastAPI()
+    app.state.config = config
+    app.state.requests = 0
+    app.state.throttled = 0
+
+    @app.middleware('http')
+    async def latency_and_throttling(request: Request, call_next):
+        app.state.requests += 1
+        delay = config.latency_ms + rng.uniform(-config.latency_jitter_ms, config.latency_jitter_ms)
+        await asyncio.sleep(max(delay, 0) / 1000)
+        if config.throttle_rate and rng.random() < config.throttle_rate:
+            app.state.throttled += 1
+            return JSONResponse(
+                status_code=429,
+                content={'errors': [{'error': {'type': 'RATE_LIMIT_REACHED'}}]},
+                headers={'Retry-After': str(config.retry_after)},
+            )
+        return await call_next(request)
+
+    # Airtable
+    @app.get('/v0/meta/bases')
+    async def airtable_bases(offset: str = None):
+        bases, next_offset = _cursor_page(data.bases, offset, config.page_size)
+        body = {'bases': bases}
+        if next_offset:
+            body['offset'] = next_offset
+        return body
+
+    @app.get('/v0/meta/bases/{base_id}/tables')
+    async def airtable_tables(base_id: str):
+        if base_id not in data.tables:
+            return JSONResponse(status_code=404, content={'error': 'NOT_FOUND'})
+        return {'tables': data.tables[base_id]}
+
+    # Notion
+    @app.post('/v1/search')
+    async def notion_search(request: Request):
+        body = await request.json()
+        results, next_cursor = _cursor_page(data.notion_pages, body.get('start_cursor'), min(body.get('page_size', 100), 100))
+        return {'object': 'list', 'results': results, 'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+
+    @app.get('/v1/blocks/{block_id}/children')
+    async def notion_block_children(block_id: str, start_cursor: str = None, page_size: int = 100):
+        results, next_cursor = _cursor_page(data.notion_blocks.get(block_id, []), start_cursor, min(page_size, 100))
+        return {'object': 'list', 'results': results, 'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+
+    # HubSpot
+    @app.get('/crm/v3/objects/{object_type}')
+    async def hubspot_list(object_type: str, after: str = None, limit: int = 100, archived: bool = False):
+        rows = [] if archived else data.hubspot.get(object_type, [])
+        page, next_after = _cursor_page(rows, after, min(limit, 100))
+        body = {'results': [_public(row) for row in page]}
+        if next_after:
+            body['paging'] = {'next': {'after': next_after}}
+        return body
+
+    @app.post('/crm/v3/objects/{object_type}/search')
+    async def hubspot_search(object_type: str, request: Request):
+        body = await request.json()
+        rows = data.hubspot.get(object_type, [])
+        for group in body.get('filterGroups', []):
+            for condition in group.get('filters', []):
+                if condition.get('operator') == 'BETWEEN':
+                    low, high = int(condition['value']), int(condition['highValue'])
+                    rows = [row for row in rows if low <= row['_modified_ms'] <= high]
+        sorts = body.get('sorts') or []
+        if sorts and sorts[0].get('direction') == 'DESCENDING':
+            rows = rows[::-1]
+        page, next_after = _cursor_page(rows, body.get('after'), min(body.get('limit', 100), 100))
+        response = {'total': len(rows), 'results': [_public(row) for row in page]}
+        if next_after:
+            response['paging'] = {'next': {'after': next_after}}
+        return response
+
+    return app
+
+
+def upstream_overrides(base_url):
+    """HTTP_UPSTREAM_OVERRIDES value routing every provider host to a mock server."""
+    return ','.join(f'{host}={base_url}' for host in PROVIDER_HOSTS)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=MockConfig.latency_ms)
+    parser.add_argument('--throttle-rate', type=float, default=MockConfig.throttle_rate)
+    args = parser.parse_args()
+    print(f"HTTP_UPSTREAM_OVERRIDES='{upstream_overrides(f'http://{args.host}:{args.port}')}'")
+    uvicorn.run(create_mock_app(MockConfig(latency_ms=args.latency_ms, throttle_rate=args.throttle_rate)), host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,271 @@
+"""Benchmark the loaders and load routes against local stand-in provider APIs.
+
+    cd backend && python -m benchmarks.run --iterations 20 --concurrency 4 --json results.json
+    python -m benchmarks.run --baseline results.json   # exit 1 if anything regressed
+
+Each scenario is run `iterations` times with `concurrency` calls in flight, every caller
+using its own access token. Latency and throughput come from those runs; peak memory from
+one extra run under tracemalloc, so tracing doesn't skew the timings. Route scenarios go
+through the FastAPI app in-process and need a reachable Redis; they are skipped otherwise.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+import tracemalloc
+
+import httpx
+import uvicorn
+
+from benchmarks.mock_providers import MockConfig, create_mock_app, upstream_overrides
+
+PROVIDERS = ('airtable', 'notion', 'hubspot')
+SCENARIO_KINDS = ('loader', 'route')
+
+
+def start_mock_server(config, port):
+    """Serve the mock providers from a background thread; returns (server, base url)."""
+    server = uvicorn.Server(uvicorn.Config(create_mock_app(config), host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f'Mock provider server failed to start on port {port}')
+        time.sleep(0.05)
+    return server, f'http://127.0.0.1:{port}'
+
+
+def loader_call(provider):
+    """Coroutine function running one full load of `provider` for an access token; returns the item count."""
+    if provider == 'airtable':
+        from integrations.airtable import get_items_airtable
+
+        async def call(token):
+            return len(await get_items_airtable(json.dumps({'access_token': token})))
+    elif provider == 'notion':
+        from integrations.notion import get_items_notion
+
+        async def call(token):
+            return len(await get_items_notion(json.dumps({'access_token': token})))
+    else:
+        from integrations.hubspot import get_items_hubspot
+
+        async def call(token):
+            result = await get_items_hubspot({'access_token': token})
+            if 'error' in result:
+                raise RuntimeError(result['error'])
+            return result['count']
+    return call
+
+
+def route_call(provider, client):
+    """Coroutine function POSTing one uncached load through the FastAPI route."""
+    async def call(token):
+        if provider == 'hubspot':
+            response = await client.post(f'/integrations/{provider}/load', params={'refresh': 'true'}, json={'access_token': token})
+        else:
+            response = await client.post(f'/integrations/{provider}/load', data={'credentials': json.dumps({'access_token': token}), 'refresh': 'true'})
+        if response.status_code != 200:
+            raise RuntimeError(f'{response.status_code}: {response.text[:200]}')
+        payload = response.json()
+        return payload['count'] if isinstance(payload, dict) else len(payload)
+    return call
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)]
+
+
+async def run_scenario(call, iterations, concurrency):
+    latencies = []
+    items = 0
+    errors = []
+    queue = asyncio.Queue()
+    for i in range(iterations):
+        queue.put_nowait(i)
+
+    async def worker(worker_id):
+        nonlocal items
+        token = f'bench-token-{worker_id}'
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                count = await call(token)
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            latencies.append(time.perf_counter() - started)
+            items += count
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(worker_id) for worker_id in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'elapsed_s': elapsed,
+        'calls_per_s': len(latencies) / elapsed if elapsed else 0.0,
+        'items_per_s': items / elapsed if elapsed else 0.0,
+        'items_per_call': items / len(latencies) if latencies else 0,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+async def peak_memory(call):
+    """Peak Python heap allocated during one call, in MiB."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        await call('bench-token-memory')
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+async def redis_available():
+    from redis_client import redis_client
+    try:
+        await redis_client.ping()
+        return True
+    except Exception:
+        return False
+
+
+async def run_benchmarks(args, base_url):
+    # Imported only now so the override and rate limit settings below apply to them
+    import http_client
+    import rate_limiter
+
+    for host in upstream_overrides(base_url).split(','):
+        name, target = host.split('=', 1)
+        http_client.UPSTREAM_OVERRIDES[name] = target
+    rate_limiter.RATE_LIMIT_BACKEND = args.rate_limit_backend
+    if args.no_rate_limits:
+        rate_limiter.TOKEN_RATE_LIMITS.clear()
+
+    scenarios = []
+    if 'loader' in args.kinds:
+        scenarios += [(f'loader:{provider}', loader_call(provider)) for provider in args.providers]
+    client = None
+    if 'route' in args.kinds:
+        if await redis_available():
+            import main
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://benchmark', timeout=None)
+            scenarios += [(f'route:{provider}', route_call(provider, client)) for provider in args.providers]
+        else:
+            print('Redis is not reachable; skipping route scenarios', file=sys.stderr)
+
+    results = {}
+    try:
+        for name, call in scenarios:
+            await call('bench-token-warmup')
+            stats = await run_scenario(call, args.iterations, args.concurrency)
+            stats['peak_memory_mib'] = await peak_memory(call)
+            results[name] = stats
+            print(format_row(name, stats), flush=True)
+    finally:
+        if client is not None:
+            await client.aclose()
+        await http_client.close_http_clients()
+    return results
+
+
+HEADER = f"{'scenario':<18}{'calls':>7}{'errors':>7}{'items/call':>11}{'calls/s':>9}{'items/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'peak MiB':>10}"
+
+
+def format_row(name, stats):
+    def number(value, digits=1):
+        return '-' if value is None else f'{value:.{digits}f}'
+    return (
+        f"{name:<18}{stats['calls']:>7}{stats['errors']:>7}{number(stats['items_per_call'], 0):>11}"
+        f"{number(stats['calls_per_s'], 2):>9}{number(stats['items_per_s'], 0):>10}"
+        f"{number(stats['p50_ms']):>9}{number(stats['p99_ms']):>9}{number(stats['peak_memory_mib']):>10}"
+    )
+
+
+def find_regressions(results, baseline, tolerance):
+    """Scenarios whose p50/p99 latency or peak memory grew, or throughput fell, by more than `tolerance`."""
+    regressions = []
+    for name, stats in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric in ('p50_ms', 'p99_ms', 'peak_memory_mib'):
+            if stats.get(metric) is not None and previous.get(metric) and stats[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f'{name} {metric}: {previous[metric]:.1f} -> {stats[metric]:.1f}')
+        if previous.get('items_per_s') and stats['items_per_s'] < previous['items_per_s'] * (1 - tolerance):
+            regressions.append(f"{name} items_per_s: {previous['items_per_s']:.0f} -> {stats['items_per_s']:.0f}")
+        if stats['errors'] > previous.get('errors', 0):
+            regressions.append(f"{name} errors: {previous.get('errors', 0)} -> {stats['errors']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    defaults = MockConfig()
+    parser = argparse.ArgumentParser(description='Benchmark the integration loaders against local mock provider APIs.')
+    parser.add_argument('--providers', nargs='+', choices=PROVIDERS, default=list(PROVIDERS))
+    parser.add_argument('--kinds', nargs='+', choices=SCENARIO_KINDS, default=list(SCENARIO_KINDS))
+    parser.add_argument('--iterations', type=int, default=10, help='loads per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='loads in flight at once')
+    parser.add_argument('--port', type=int, default=8900, help='port for the mock provider server')
+    parser.add_argument('--airtable-bases', type=int, default=defaults.airtable_bases)
+    parser.add_argument('--airtable-tables-per-base', type=int, default=defaults.airtable_tables_per_base)
+    parser.add_argument('--notion-pages', type=int, default=defaults.notion_pages)
+    parser.add_argument('--notion-blocks-per-page', type=int, default=defaults.notion_blocks_per_page)
+    parser.add_argument('--hubspot-objects', type=int, default=defaults.hubspot_objects_per_type, help='objects per CRM type')
+    parser.add_argument('--page-size', type=int, default=defaults.page_size)
+    parser.add_argument('--latency-ms', type=float, default=defaults.latency_ms)
+    parser.add_argument('--throttle-rate', type=float, default=defaults.throttle_rate, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=defaults.retry_after)
+    parser.add_argument('--rate-limit-backend', choices=('local', 'redis'), default='local')
+    parser.add_argument('--no-rate-limits', action='store_true', help="measure the code alone, without the providers' quotas")
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results file from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression against the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = MockConfig(
+        airtable_bases=args.airtable_bases,
+        airtable_tables_per_base=args.airtable_tables_per_base,
+        notion_pages=args.notion_pages,
+        notion_blocks_per_page=args.notion_blocks_per_page,
+        hubspot_objects_per_type=args.hubspot_objects,
+        page_size=args.page_size,
+        latency_ms=args.latency_ms,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+    )
+    server, base_url = start_mock_server(config, args.port)
+    try:
+        print(HEADER)
+        results = asyncio.run(run_benchmarks(args, base_url))
+    finally:
+        server.should_exit = True
+    print(f'mock server: {server.config.app.state.requests} requests, {server.config.app.state.throttled} throttled')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+from redis_client import (
+    add_key_value_redis,
+    add_key_value_if_absent_redis,
+    get_value_redis,
+    delete_key_redis,
+)
+
+logger = logging.getLogger(__name__)
+
+# Credentials with a refresh token, or whose tokens don't expire, are kept this long
+CREDENTIALS_TTL = int(os.environ.get('CREDENTIALS_TTL', 30 * 24 * 3600))
+# Expiry used for credentials that can't be refreshed and don't say when they expire
+CREDENTIALS_DEFAULT_TTL = int(os.environ.get('CREDENTIALS_DEFAULT_TTL', 600))
+# Access tokens are renewed once they are this close to expiring
+CREDENTIALS_REFRESH_MARGIN = int(os.environ.get('CREDENTIALS_REFRESH_MARGIN', 300))
+CREDENTIALS_REFRESH_LOCK_TIMEOUT = 30
+CREDENTIALS_POLL_INTERVAL = 0.2
+
+# Short-lived copy of recently read credentials, so hot paths skip the Redis round trip
+_local_cache = TTLCache(
+    maxsize=int(os.environ.get('CREDENTIALS_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('CREDENTIALS_CACHE_TTL', 30)),
+)
+# Refreshes in flight in this process, so concurrent readers share one token request
+_refreshing = {}
+
+
+def _credentials_key(provider, user_id, org_id):
+    return f'{provider}_credentials:{org_id}:{user_id}'
+
+
+def _needs_refresh(credentials):
+    expires_at = credentials.get('expires_at')
+    return bool(credentials.get('refresh_token')) and expires_at is not None and expires_at - time.time() < CREDENTIALS_REFRESH_MARGIN
+
+
+async def store_credentials(provider, user_id, org_id, token_data, previous=None, expire=None):
+    """Save a token response, stamping the absolute expiry of its access token.
+
+    `previous` carries the refresh token over when a refresh response doesn't rotate it.
+    `expire` (seconds) is for providers that know how long their tokens last, e.g. CREDENTIALS_TTL
+    for ones that never expire; otherwise it follows the token response.
+    """
+    credentials = dict(token_data)
+    if previous and not credentials.get('refresh_token') and previous.get('refresh_token'):
+        credentials['refresh_token'] = previous['refresh_token']
+    if credentials.get('expires_in'):
+        credentials['expires_at'] = time.time() + int(credentials['expires_in'])
+
+    if expire is None:
+        if credentials.get('refresh_token'):
+            expire = CREDENTIALS_TTL
+        elif credentials.get('expires_in'):
+            expire = int(credentials['expires_in'])
+        else:
+            expire = CREDENTIALS_DEFAULT_TTL
+
+    key = _credentials_key(provider, user_id, org_id)
+    await add_key_value_redis(key, json.dumps(credentials), expire=expire)
+    _local_cache[key] = credentials
+    return credentials
+
+
+async def _read_credentials(key):
+    credentials = await get_value_redis(key)
+    if not credentials:
+        return None
+    credentials = json.loads(credentials)
+    _local_cache[key] = credentials
+    return credentials
+
+
+async def _refresh(provider, user_id, org_id, credentials, refresher):
+    """Renew the access token once across workers; the Redis lock holder refreshes, others wait for it."""
+    key = _credentials_key(provider, user_id, org_id)
+    lock_key = f'{key}:refresh_lock'
+    if not await add_key_value_if_absent_redis(lock_key, 1, CREDENTIALS_REFRESH_LOCK_TIMEOUT):
+        deadline = time.monotonic() + CREDENTIALS_REFRESH_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(CREDENTIALS_POLL_INTERVAL)
+            latest = await _read_credentials(key)
+            if latest is None or not _needs_refresh(latest):
+                return latest
+            if not await get_value_redis(lock_key):
+                break
+        return await _refresh(provider, user_id, org_id, credentials, refresher)
+
+    latest = credentials
+    try:
+        # Another worker may have finished a refresh between our read and taking the lock
+        latest = await _read_credentials(key) or credentials
+        if not _needs_refresh(latest):
+            return latest
+        token_data = await refresher(latest['refresh_token'])
+        return await store_credentials(provider, user_id, org_id, token_data, previous=latest)
+    except HTTPException:
+        if latest.get('expires_at', 0) > time.time():
+            # Still usable; the next read inside the margin tries again
+            logger.warning('Refreshing %s credentials failed; using the current access token', provider)
+            return latest
+        raise
+    finally:
+        await delete_key_redis(lock_key)
+
+
+async def get_credentials(provider, user_id, org_id, refresher=None):
+    """Stored credentials for a user, renewed through `refresher` shortly before they expire.
+
+    `refresher` is a coroutine function taking a refresh token and returning the provider's
+    token response. Reads don't consume the credentials, so they serve any number of loads.
+    """
+    key = _credentials_key(provider, user_id, org_id)
+    credentials = _local_cache.get(key)
+    if credentials is None:
+        credentials = await _read_credentials(key)
+    if not credentials:
+        raise HTTPException(status_code=400, detail='No credentials found.')
+    if refresher is None or not _needs_refresh(credentials):
+        return credentials
+
+    task = _refreshing.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_refresh(provider, user_id, org_id, credentials, refresher))
+        _refreshing[key] = task
+        task.add_done_callback(lambda _: _refreshing.pop(key, None))
+    credentials = await asyncio.shield(task)
+    if not credentials:
+        raise HTTPException(status_code=400, detail='No credentials found.')
+    return credentials
+
@@ -0,0 +1,25 @@
+import json
+from fastapi import HTTPException
+
+from redis_client import add_key_value_redis, get_value_redis
+
+# Watermarks outlive credentials; a sync older than this just falls back to a full load
+WATERMARK_EXPIRE = 30 * 24 * 3600
+
+def _watermark_key(provider, org_id, user_id):
+    return f'{provider}_watermark:{org_id}:{user_id}'
+
+async def get_watermark(provider, user_id, org_id):
+    """Load the delta-sync state saved by the previous load, or None on first sync."""
+    if not user_id or not org_id:
+        raise HTTPException(status_code=400, detail='user_id and org_id are required for delta loads.')
+    watermark = await get_value_redis(_watermark_key(provider, org_id, user_id))
+    return json.loads(watermark) if watermark else None
+
+async def save_watermark(provider, user_id, org_id, watermark):
+    await add_key_value_redis(_watermark_key(provider, org_id, user_id), json.dumps(watermark), expire=WATERMARK_EXPIRE)
+
+def latest_modified_time(last_modified_times, default=None):
+    """Newest modification time as an ISO string, used as the next watermark."""
+    last_modified_times = [time for time in last_modified_times if time is not None]
+    return max(last_modified_times).isoformat() if last_modified_times else default
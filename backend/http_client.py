@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+from urllib.parse import urlsplit
+import httpx
+
+import metrics
+import rate_limiter
+
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 30))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', 20))
+HTTP_MAX_KEEPALIVE_PER_HOST = int(os.environ.get('HTTP_MAX_KEEPALIVE_PER_HOST', 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 30))
+HTTP_MAX_CONCURRENCY_PER_HOST = int(os.environ.get('HTTP_MAX_CONCURRENCY_PER_HOST', HTTP_MAX_CONNECTIONS_PER_HOST))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 5))
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+# Send a provider's traffic elsewhere, e.g. to the benchmark stand-ins:
+# HTTP_UPSTREAM_OVERRIDES='api.notion.com=http://127.0.0.1:8900,api.hubapi.com=http://127.0.0.1:8900'
+UPSTREAM_OVERRIDES = dict(
+    entry.split('=', 1) for entry in os.environ.get('HTTP_UPSTREAM_OVERRIDES', '').split(',') if '=' in entry
+)
+
+# One pooled client and one concurrency gate per upstream host, shared for the app lifetime
+_clients = {}
+_semaphores = {}
+
+
+def _get_client(host):
+    client = _clients.get(host)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED,
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_PER_HOST,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _clients[host] = client
+    return client
+
+
+def _get_semaphore(host):
+    semaphore = _semaphores.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(HTTP_MAX_CONCURRENCY_PER_HOST)
+        _semaphores[host] = semaphore
+    return semaphore
+
+
+async def request(method, url, idempotent=None, **kwargs) -> httpx.Response:
+    """Send a request through the shared connection pool for the url's host.
+
+    Requests wait on the provider's rate limit buckets first. 429s are retried after
+    Retry-After (or jittered backoff); server errors and transport failures are retried
+    only for idempotent requests, which defaults to GET/HEAD but read-only POSTs can opt in.
+    """
+    split_url = urlsplit(url)
+    host = split_url.netloc
+    buckets = rate_limiter.buckets_for(host, split_url.path, kwargs.get('headers'))
+    if host in UPSTREAM_OVERRIDES:
+        url = UPSTREAM_OVERRIDES[host].rstrip('/') + url[len(f'{split_url.scheme}://{host}'):]
+    if idempotent is None:
+        idempotent = method in ('GET', 'HEAD')
+    provider, endpoint = metrics.upstream_labels(host, split_url.path)
+    latency = metrics.UPSTREAM_LATENCY.labels(provider, endpoint)
+
+    attempt = 0
+    while True:
+        await rate_limiter.acquire(buckets)
+        started = time.perf_counter()
+        try:
+            async with _get_semaphore(host):
+                response = await _get_client(host).request(method, url, **kwargs)
+        except httpx.TransportError:
+            latency.observe(time.perf_counter() - started)
+            metrics.UPSTREAM_REQUESTS.labels(provider, endpoint, 'transport_error').inc()
+            if not idempotent or attempt >= HTTP_MAX_RETRIES:
+                raise
+            metrics.UPSTREAM_RETRIES.labels(provider, endpoint, 'transport_error').inc()
+            await asyncio.sleep(rate_limiter.backoff(attempt))
+            attempt += 1
+            continue
+        latency.observe(time.perf_counter() - started)
+        metrics.UPSTREAM_REQUESTS.labels(provider, endpoint, str(response.status_code)).inc()
+        metrics.UPSTREAM_RESPONSE_BYTES.labels(provider, endpoint).inc(len(response.content))
+
+        await rate_limiter.observe(buckets, response)
+        throttled = response.status_code == 429
+        if attempt >= HTTP_MAX_RETRIES or not (throttled or (idempotent and response.status_code in RETRYABLE_STATUS_CODES)):
+            return response
+        metrics.UPSTREAM_RETRIES.labels(provider, endpoint, str(response.status_code)).inc()
+
+        delay = rate_limiter.retry_after(response)
+        if delay is None:
+            delay = rate_limiter.backoff(attempt)
+        if throttled:
+            # Hold back every request sharing this quota, not just the one that hit the limit
+            await rate_limiter.pause(buckets, delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def get(url, **kwargs) -> httpx.Response:
+    return await request('GET', url, **kwargs)
+
+
+async def post(url, **kwargs) -> httpx.Response:
+    return await request('POST', url, **kwargs)
+
+
+async def close_http_clients():
+    """Close every pooled client; called on app shutdown."""
+    clients = list(_clients.values())
+    _clients.clear()
+    _semaphores.clear()
+    await asyncio.gather(*(client.aclose() for client in clients))
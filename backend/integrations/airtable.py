@@ -3,17 +3,28 @@
 import datetime
 import json
 import secrets
+import time
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
 import asyncio
 import base64
+import collections
 import hashlib
+import hmac
+import logging
+import os
 
-import requests
+import orjson
+
+import http_client
+from credential_manager import get_credentials, store_credentials
+from delta_sync import get_watermark, save_watermark
+import metrics
+from metrics import observe_conversion
 from integrations.integration_item import IntegrationItem
+from webhooks import buffer_events, apply_item_changes
 
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from redis_client import add_key_value_redis, add_key_values_redis, get_value_redis, get_and_delete_values_redis, delete_key_redis
 
 # CLIENT_ID = 'XXX'
 # CLIENT_SECRET = 'XXX'
@@ -23,7 +34,20 @@ REDIRECT_URI = 'http://localhost:8000/integrations/airtable/oauth2callback'
 authorization_url = f'https://airtable.com/oauth2/v1/authorize?client_id={CLIENT_ID}&response_type=code&owner=user&redirect_uri=http%3A%2F%2Flocalhost%3A8000%2Fintegrations%2Fairtable%2Foauth2callback'
 
 encoded_client_id_secret = base64.b64encode(f'{CLIENT_ID}:{CLIENT_SECRET}'.encode()).decode()
-scope = 'data.records:read data.records:write data.recordComments:read data.recordComments:write schema.bases:read schema.bases:write'
+scope = 'data.records:read data.records:write data.recordComments:read data.recordComments:write schema.bases:read schema.bases:write webhook:manage'
+
+logger = logging.getLogger(__name__)
+
+# Airtable allows 5 requests/second per base; each base only needs one schema call,
+# so this caps how many bases are queried at once
+TABLES_FETCH_CONCURRENCY = 5
+
+# Public URL of /integrations/airtable/webhooks/events, where Airtable sends notifications
+AIRTABLE_WEBHOOK_URL = os.getenv('AIRTABLE_WEBHOOK_URL')
+# Only schema changes matter: the items are bases and tables
+AIRTABLE_WEBHOOK_SPECIFICATION = {'options': {'filters': {'dataTypes': ['tableMetadata']}}}
+# Airtable webhooks expire (after 7 days); each is refreshed this many seconds before it would
+AIRTABLE_WEBHOOK_REFRESH_MARGIN = float(os.getenv('AIRTABLE_WEBHOOK_REFRESH_MARGIN', 24 * 60 * 60))
 
 async def authorize_airtable(user_id, org_id):
     state_data = {
@@ -39,10 +63,10 @@ async def authorize_airtable(user_id, org_id):
     code_challenge = base64.urlsafe_b64encode(m.digest()).decode('utf-8').replace('=', '')
 
     auth_url = f'{authorization_url}&state={encoded_state}&code_challenge={code_challenge}&code_challenge_method=S256&scope={scope}'
-    await asyncio.gather(
-        add_key_value_redis(f'airtable_state:{org_id}:{user_id}', json.dumps(state_data), expire=600),
-        add_key_value_redis(f'airtable_verifier:{org_id}:{user_id}', code_verifier, expire=600),
-    )
+    await add_key_values_redis({
+        f'airtable_state:{org_id}:{user_id}': json.dumps(state_data),
+        f'airtable_verifier:{org_id}:{user_id}': code_verifier,
+    }, expire=600)
 
     return auth_url
 
@@ -57,35 +81,33 @@ async def oauth2callback_airtable(request: Request):
     user_id = state_data.get('user_id')
     org_id = state_data.get('org_id')
 
-    saved_state, code_verifier = await asyncio.gather(
-        get_value_redis(f'airtable_state:{org_id}:{user_id}'),
-        get_value_redis(f'airtable_verifier:{org_id}:{user_id}'),
+    # State and verifier are single-use, so they are read and removed in one round trip
+    saved_state, code_verifier = await get_and_delete_values_redis(
+        f'airtable_state:{org_id}:{user_id}',
+        f'airtable_verifier:{org_id}:{user_id}',
     )
 
     if not saved_state or original_state != json.loads(saved_state).get('state'):
         raise HTTPException(status_code=400, detail='State does not match.')
 
-    async with httpx.AsyncClient() as client:
-        response, _, _ = await asyncio.gather(
-            client.post(
-                'https://airtable.com/oauth2/v1/token',
-                data={
-                    'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': REDIRECT_URI,
-                    'client_id': CLIENT_ID,
-                    'code_verifier': code_verifier.decode('utf-8'),
-                },
-                headers={
-                    'Authorization': f'Basic {encoded_client_id_secret}',
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                }
-            ),
-            delete_key_redis(f'airtable_state:{org_id}:{user_id}'),
-            delete_key_redis(f'airtable_verifier:{org_id}:{user_id}'),
-        )
+    response = await http_client.post(
+        'https://airtable.com/oauth2/v1/token',
+        data={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI,
+            'client_id': CLIENT_ID,
+            'code_verifier': code_verifier.decode('utf-8'),
+        },
+        headers={
+            'Authorization': f'Basic {encoded_client_id_secret}',
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+    )
 
-    await add_key_value_redis(f'airtable_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail='Failed to get Airtable token.')
+    await store_credentials('airtable', user_id, org_id, response.json())
     
     close_window_script = """
     <html>
@@ -96,15 +118,27 @@ async def oauth2callback_airtable(request: Request):
     """
     return HTMLResponse(content=close_window_script)
 
-async def get_airtable_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'airtable_credentials:{org_id}:{user_id}')
-    if not credentials:
-        raise HTTPException(status_code=400, detail='No credentials found.')
-    credentials = json.loads(credentials)
-    await delete_key_redis(f'airtable_credentials:{org_id}:{user_id}')
+async def refresh_airtable_token(refresh_token):
+    response = await http_client.post(
+        'https://airtable.com/oauth2/v1/token',
+        data={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': CLIENT_ID,
+        },
+        headers={
+            'Authorization': f'Basic {encoded_client_id_secret}',
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=401, detail='Airtable token refresh failed; authorize again.')
+    return response.json()
 
-    return credentials
+async def get_airtable_credentials(user_id, org_id):
+    return await get_credentials('airtable', user_id, org_id, refresh_airtable_token)
 
+@observe_conversion('airtable')
 def create_integration_item_metadata_object(
     response_json: str, item_type: str, parent_id=None, parent_name=None
 ) -> IntegrationItem:
@@ -120,53 +154,329 @@ def create_integration_item_metadata_object(
     return integration_item_metadata
 
 
-def fetch_items(
-    access_token: str, url: str, aggregated_response: list, offset=None
-) -> dict:
-    """Fetching the list of bases"""
-    params = {'offset': offset} if offset is not None else {}
+@observe_conversion('airtable', batch=True)
+def create_integration_items(records: list, item_type: str, parent_id=None, parent_name=None, properties=None) -> list[IntegrationItem]:
+    """Converts a list of bases or tables sharing one parent; same output as the per-record function.
+
+    With `properties` (field names), each table's `properties` holds the schema of those of its fields.
+    """
+    parent_id = None if parent_id is None else parent_id + '_Base'
+    suffix = '_' + item_type
+    projection = set(properties or ())
+    return [
+        IntegrationItem(
+            id=record.get('id', None) + suffix,
+            name=record.get('name', None),
+            type=item_type,
+            parent_id=parent_id,
+            parent_path_or_name=parent_name,
+            properties={
+                field['name']: field for field in record.get('fields', []) if field.get('name') in projection
+            } if projection else None,
+        )
+        for record in records
+    ]
+
+
+async def fetch_items(access_token: str, url: str):
+    """Yields the list of bases one page at a time, requesting the next page while the caller handles the current one"""
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers, params=params)
+    next_page = asyncio.ensure_future(http_client.get(url, headers=headers))
+    try:
+        while next_page is not None:
+            response = await next_page
+            next_page = None
+            if response.status_code != 200:
+                # Stopping silently would look like the remaining bases were deleted to delta loads
+                raise HTTPException(status_code=response.status_code, detail='Failed to list Airtable bases.')
 
-    if response.status_code == 200:
-        results = response.json().get('bases', {})
-        offset = response.json().get('offset', None)
+            response_json = response.json()
+            offset = response_json.get('offset', None)
+            if offset is not None:
+                next_page = asyncio.ensure_future(
+                    http_client.get(url, headers=headers, params={'offset': offset})
+                )
+            yield response_json.get('bases', [])
+    finally:
+        if next_page is not None:
+            next_page.cancel()
 
-        for item in results:
-            aggregated_response.append(item)
 
-        if offset is not None:
-            fetch_items(access_token, url, aggregated_response, offset)
-        else:
-            return
+async def fetch_tables(access_token: str, base: dict, semaphore: asyncio.Semaphore, properties=None) -> list[IntegrationItem]:
+    """Fetching the tables of a single base, None if the base could not be read"""
+    async with semaphore:
+        response = await http_client.get(
+            f'https://api.airtable.com/v0/meta/bases/{base.get("id")}/tables',
+            headers={'Authorization': f'Bearer {access_token}'},
+        )
 
+    if response.status_code != 200:
+        return None
+    # Schemas list every field of every table and can't be narrowed upstream; orjson keeps parsing them cheap
+    return create_integration_items(orjson.loads(response.content)['tables'], 'Table', base.get('id', None), base.get('name', None), properties)
 
-async def get_items_airtable(credentials) -> list[IntegrationItem]:
-    credentials = json.loads(credentials)
+
+async def iter_bases(access_token: str, properties=None):
+    """Yields every base paired with its tables (None if unreadable), in base order, as the tables arrive"""
     url = 'https://api.airtable.com/v0/meta/bases'
+    pending = collections.deque()
+
+    # Table fetches for a page start as soon as it arrives, overlapping with the next page download
+    semaphore = asyncio.Semaphore(TABLES_FETCH_CONCURRENCY)
+    try:
+        async for bases in fetch_items(access_token, url):
+            for response in bases:
+                pending.append((response, asyncio.ensure_future(fetch_tables(access_token, response, semaphore, properties))))
+            # Hand over whatever is already complete without holding up the next page
+            while pending and pending[0][1].done():
+                response, table_fetch = pending.popleft()
+                yield create_integration_item_metadata_object(response, 'Base'), table_fetch.result()
+
+        while pending:
+            response, table_fetch = pending.popleft()
+            yield create_integration_item_metadata_object(response, 'Base'), await table_fetch
+    finally:
+        for _, table_fetch in pending:
+            table_fetch.cancel()
+
+
+async def iter_items_airtable(credentials, properties=None):
+    """Yields the IntegrationItems of one base (the base, then its tables) at a time"""
+    credentials = json.loads(credentials)
+    async for base, tables in iter_bases(credentials.get('access_token'), properties):
+        yield [base] + (tables or [])
+
+
+async def get_items_airtable(credentials, properties=None) -> list[IntegrationItem]:
     list_of_integration_item_metadata = []
-    list_of_responses = []
+    async for items in iter_items_airtable(credentials, properties):
+        list_of_integration_item_metadata.extend(items)
 
-    fetch_items(credentials.get('access_token'), url, list_of_responses)
-    for response in list_of_responses:
-        list_of_integration_item_metadata.append(
-            create_integration_item_metadata_object(response, 'Base')
-        )
-        tables_response = requests.get(
-            f'https://api.airtable.com/v0/meta/bases/{response.get("id")}/tables',
-            headers={'Authorization': f'Bearer {credentials.get("access_token")}'},
-        )
-        if tables_response.status_code == 200:
-            tables_response = tables_response.json()
-            for table in tables_response['tables']:
-                list_of_integration_item_metadata.append(
-                    create_integration_item_metadata_object(
-                        table,
-                        'Table',
-                        response.get('id', None),
-                        response.get('name', None),
-                    )
-                )
+    logger.info('Loaded %d Airtable items', len(list_of_integration_item_metadata))
+    return list_of_integration_item_metadata
+
+
+def _item_fingerprint(item: IntegrationItem) -> str:
+    return f'{item.name}|{item.parent_id}'
+
+
+async def get_delta_items_airtable(credentials, user_id, org_id) -> list[IntegrationItem]:
+    """Returns the bases and tables changed since the last delta load, plus tombstones for removed ones.
+
+    The meta API has no modification times, so every base is still listed; each one is compared
+    against the fingerprints saved by the previous load and only the differences are returned.
+    """
+    credentials = json.loads(credentials)
+    previous = await get_watermark('airtable', user_id, org_id) or {}
+    current = {}
+    list_of_integration_item_metadata = []
+
+    async for base, tables in iter_bases(credentials.get('access_token')):
+        previous_base = previous.get(base.id, {})
+        if tables is None:
+            # Tables unreadable this time: keep what we knew rather than reporting them deleted
+            current_base = dict(previous_base)
+            current_base[base.id] = _item_fingerprint(base)
+            items = [base]
+        else:
+            items = [base] + tables
+            current_base = {item.id: _item_fingerprint(item) for item in items}
 
-    print(f'list_of_integration_item_metadata: {list_of_integration_item_metadata}')
+        for item in items:
+            if previous_base.get(item.id) != current_base[item.id]:
+                item.delta = 'upsert'
+                list_of_integration_item_metadata.append(item)
+        for item_id in previous_base.keys() - current_base.keys():
+            list_of_integration_item_metadata.append(
+                IntegrationItem(id=item_id, type=item_id.rsplit('_', 1)[-1], parent_id=base.id, delta='deleted')
+            )
+        current[base.id] = current_base
+
+    for base_id in previous.keys() - current.keys():
+        for item_id in previous[base_id]:
+            list_of_integration_item_metadata.append(
+                IntegrationItem(id=item_id, type=item_id.rsplit('_', 1)[-1], delta='deleted')
+            )
+
+    await save_watermark('airtable', user_id, org_id, current)
     return list_of_integration_item_metadata
+
+
+def _webhook_key(webhook_id):
+    return f'airtable_webhook:{webhook_id}'
+
+
+def _base_webhook_key(user_id, org_id, base_id):
+    return f'airtable_base_webhook:{org_id}:{user_id}:{base_id}'
+
+
+def _epoch_ms(timestamp):
+    """Milliseconds since the epoch for an Airtable ISO timestamp."""
+    return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp() * 1000
+
+
+async def _schedule_webhook_refresh(webhook_id, expiration_time):
+    """Have the webhook worker refresh a webhook AIRTABLE_WEBHOOK_REFRESH_MARGIN before it expires."""
+    if not expiration_time:
+        return
+    delay = _epoch_ms(expiration_time) / 1000 - time.time() - AIRTABLE_WEBHOOK_REFRESH_MARGIN
+    await buffer_events('airtable', [(f'refresh|{webhook_id}', 0, {'refresh': True})], delay=max(delay, 0))
+
+
+async def subscribe_webhooks_airtable(user_id, org_id):
+    """Create a table metadata webhook on every base of the account that doesn't have one yet.
+
+    Airtable only returns a webhook's MAC secret when it is created, so it is stored with the
+    account and the payload cursor under the webhook id. Every webhook, new or existing, has its
+    refresh scheduled so it doesn't lapse.
+    """
+    if not AIRTABLE_WEBHOOK_URL:
+        raise HTTPException(status_code=400, detail='AIRTABLE_WEBHOOK_URL is not configured.')
+    credentials = await get_airtable_credentials(user_id, org_id)
+    headers = {'Authorization': f'Bearer {credentials.get("access_token")}'}
+    webhook_ids = []
+    async for bases in fetch_items(credentials.get('access_token'), 'https://api.airtable.com/v0/meta/bases'):
+        for base in bases:
+            existing = await get_value_redis(_base_webhook_key(user_id, org_id, base['id']))
+            if existing:
+                webhook_id = existing.decode('utf-8')
+                entry = await get_value_redis(_webhook_key(webhook_id))
+                if entry:
+                    await _schedule_webhook_refresh(webhook_id, json.loads(entry).get('expiration_time'))
+                webhook_ids.append(webhook_id)
+                continue
+            response = await http_client.post(
+                f'https://api.airtable.com/v0/bases/{base["id"]}/webhooks',
+                json={'notificationUrl': AIRTABLE_WEBHOOK_URL, 'specification': AIRTABLE_WEBHOOK_SPECIFICATION},
+                headers=headers,
+            )
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=f'Failed to create an Airtable webhook: {response.text}')
+            webhook = response.json()
+            await add_key_values_redis({
+                _webhook_key(webhook['id']): json.dumps({
+                    'user_id': user_id,
+                    'org_id': org_id,
+                    'base_id': base['id'],
+                    'base_name': base.get('name'),
+                    'mac_secret': webhook['macSecretBase64'],
+                    'expiration_time': webhook.get('expirationTime'),
+                    'cursor': 1,
+                }),
+                _base_webhook_key(user_id, org_id, base['id']): webhook['id'],
+            })
+            await _schedule_webhook_refresh(webhook['id'], webhook.get('expirationTime'))
+            webhook_ids.append(webhook['id'])
+    return {'webhooks': webhook_ids}
+
+
+def verify_airtable_signature(body, mac_header, mac_secret):
+    """Check X-Airtable-Content-MAC: hex HMAC-SHA256 of the body, keyed by the webhook's MAC secret."""
+    if not mac_header:
+        return False
+    expected = 'hmac-sha256=' + hmac.new(base64.b64decode(mac_secret), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, mac_header)
+
+
+async def receive_webhook_airtable(request: Request):
+    """Verify a notification and buffer it; every notification of a webhook coalesces into one payload read.
+
+    The MAC secret belongs to the webhook named in the body, so the body is parsed first; anything
+    that isn't a notification is rejected with 400 and a bad signature with 401.
+    """
+    body = await request.body()
+    try:
+        notification = json.loads(body)
+        webhook_id = notification['webhook']['id']
+        timestamp = notification.get('timestamp')
+        occurred_at = _epoch_ms(timestamp) if timestamp else 0
+    except (ValueError, TypeError, KeyError, AttributeError):
+        metrics.WEBHOOK_EVENTS.labels('airtable', 'rejected').inc()
+        raise HTTPException(status_code=400, detail='Malformed Airtable webhook notification.')
+    webhook = await get_value_redis(_webhook_key(webhook_id)) if isinstance(webhook_id, str) else None
+    if not webhook or not verify_airtable_signature(body, request.headers.get('X-Airtable-Content-MAC'), json.loads(webhook)['mac_secret']):
+        metrics.WEBHOOK_EVENTS.labels('airtable', 'rejected').inc()
+        raise HTTPException(status_code=401, detail='Invalid Airtable webhook signature.')
+    await buffer_events('airtable', [(webhook_id, occurred_at, {})])
+    return {'buffered': 1}
+
+
+async def _list_webhook_payloads(access_token, base_id, webhook_id, cursor):
+    """Yields the payloads recorded since `cursor`, then returns; the next cursor is the last yielded one's."""
+    while True:
+        response = await http_client.get(
+            f'https://api.airtable.com/v0/bases/{base_id}/webhooks/{webhook_id}/payloads',
+            params={'cursor': cursor},
+            headers={'Authorization': f'Bearer {access_token}'},
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail='Failed to list Airtable webhook payloads.')
+        response_json = response.json()
+        cursor = response_json.get('cursor', cursor)
+        yield response_json.get('payloads', []), cursor
+        if not response_json.get('mightHaveMore'):
+            break
+
+
+async def _refresh_webhook(webhook_id, webhook, credentials):
+    """Extend a webhook's life and schedule the next refresh; a webhook Airtable no longer knows is forgotten."""
+    response = await http_client.post(
+        f'https://api.airtable.com/v0/bases/{webhook["base_id"]}/webhooks/{webhook_id}/refresh',
+        headers={'Authorization': f'Bearer {credentials.get("access_token")}'},
+    )
+    if response.status_code == 404:
+        logger.warning('Airtable webhook %s is gone; subscribe again to recreate it', webhook_id)
+        await delete_key_redis(_webhook_key(webhook_id))
+        await delete_key_redis(_base_webhook_key(webhook['user_id'], webhook['org_id'], webhook['base_id']))
+        return
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f'Failed to refresh Airtable webhook {webhook_id}.')
+    webhook['expiration_time'] = response.json().get('expirationTime')
+    await add_key_value_redis(_webhook_key(webhook_id), json.dumps(webhook))
+    await _schedule_webhook_refresh(webhook_id, webhook['expiration_time'])
+
+
+async def apply_webhook_events_airtable(events):
+    """Read each notified webhook's new payloads and apply the table changes in them to its account.
+
+    Refresh events scheduled by _schedule_webhook_refresh extend the webhook's expiration instead.
+    """
+    for key, _, event in events:
+        webhook_id = key.rpartition('|')[2]
+        entry = await get_value_redis(_webhook_key(webhook_id))
+        if not entry:
+            continue
+        webhook = json.loads(entry)
+        try:
+            credentials = await get_airtable_credentials(webhook['user_id'], webhook['org_id'])
+        except HTTPException as e:
+            # A disconnected account can't be read; retrying wouldn't help, and its events mustn't hold up the batch
+            logger.info('Skipping webhook events for a disconnected Airtable account: %s', e.detail)
+            continue
+        if event.get('refresh'):
+            await _refresh_webhook(webhook_id, webhook, credentials)
+            continue
+
+        # Table id -> latest name, or None once destroyed; later payloads override earlier ones
+        tables = {}
+        cursor = webhook['cursor']
+        async for payloads, cursor in _list_webhook_payloads(credentials.get('access_token'), webhook['base_id'], webhook_id, cursor):
+            for payload in payloads:
+                for table_id, created in payload.get('createdTablesById', {}).items():
+                    tables[table_id] = created.get('metadata', {}).get('name')
+                for table_id, changed in payload.get('changedTablesById', {}).items():
+                    current = changed.get('changedMetadata', {}).get('current', {})
+                    if 'name' in current:
+                        tables[table_id] = current['name']
+                for table_id in payload.get('destroyedTableIds', []):
+                    tables[table_id] = None
+
+        upserts = create_integration_items(
+            [{'id': table_id, 'name': name} for table_id, name in tables.items() if name is not None],
+            'Table', webhook['base_id'], webhook['base_name'],
+        )
+        deleted = [('Table', f'{table_id}_Table') for table_id, name in tables.items() if name is None]
+        if upserts or deleted:
+            await apply_item_changes('airtable', webhook['user_id'], webhook['org_id'], json.dumps(credentials), upserts, deleted)
+        webhook['cursor'] = cursor
+        await add_key_value_redis(_webhook_key(webhook_id), json.dumps(webhook))
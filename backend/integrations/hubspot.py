@@ -1,27 +1,67 @@
 import secrets
 import json
+import time
+import hmac
 import base64
 import hashlib
-import aiohttp
 import asyncio
 import datetime
+import functools
+import logging
+import orjson
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
-from dotenv import load_dotenv
 import os
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+import http_client
+from credential_manager import get_credentials, store_credentials
+from delta_sync import get_watermark, save_watermark, latest_modified_time
+import metrics
+from metrics import observe_conversion
+from redis_client import add_key_values_redis, get_and_delete_values_redis, add_set_member_redis, get_set_members_redis
+from webhooks import buffer_events, apply_item_changes
 from .integration_item import IntegrationItem
-import requests
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 # HubSpot app credentials
 HUBSPOT_CLIENT_ID = os.getenv("HUBSPOT_CLIENT_ID")
 HUBSPOT_CLIENT_SECRET = os.getenv("HUBSPOT_CLIENT_SECRET")
 HUBSPOT_REDIRECT_URI = "http://localhost:8000/integrations/hubspot/oauth2callback"
 HUBSPOT_SCOPE = "crm.objects.contacts.read crm.objects.contacts.write crm.objects.deals.read crm.objects.deals.write crm.schemas.contacts.read crm.schemas.deals.read oauth"
-HUBSPOT_AUTH_URL = f"https://app.hubspot.com/oauth/authorize?client_id={HUBSPOT_CLIENT_ID}&redirect_uri={HUBSPOT_REDIRECT_URI}&scope={HUBSPOT_SCOPE}&response_type=code"
+# Companies/tickets are requested as optional so apps without those scopes can still connect
+HUBSPOT_OPTIONAL_SCOPE = "crm.objects.companies.read tickets"
+HUBSPOT_AUTH_URL = f"https://app.hubspot.com/oauth/authorize?client_id={HUBSPOT_CLIENT_ID}&redirect_uri={HUBSPOT_REDIRECT_URI}&scope={HUBSPOT_SCOPE}&optional_scope={HUBSPOT_OPTIONAL_SCOPE}&response_type=code"
+
+# CRM object loading
+HUBSPOT_OBJECTS_URL = "https://api.hubapi.com/crm/v3/objects"
+HUBSPOT_PAGE_LIMIT = 100
+HUBSPOT_OBJECT_TYPES = {
+    # object type path -> (IntegrationItem type, properties the item's name and URL are built from)
+    "contacts": ("contact", "firstname,lastname,hs_object_id"),
+    "deals": ("deal", "dealname"),
+    "companies": ("company", "name"),
+    "tickets": ("ticket", "subject"),
+}
+# Per-load budget so a single huge portal can't monopolise a worker
+HUBSPOT_MAX_ITEMS = int(os.getenv("HUBSPOT_MAX_ITEMS", 10000))
+HUBSPOT_MAX_PAGES = int(os.getenv("HUBSPOT_MAX_PAGES", 100))
+
+# Search mode: partition the last-modified range into windows pulled in parallel
+HUBSPOT_SEARCH_WINDOWS = int(os.getenv("HUBSPOT_SEARCH_WINDOWS", 8))
+HUBSPOT_SEARCH_RESULT_CAP = 10000  # search refuses to page past this many results per query
+HUBSPOT_MODIFIED_PROPERTY = {"contacts": "lastmodifieddate"}  # every other type uses hs_lastmodifieddate
+
+# Record links by item type; types without one (their ids aren't contact ids) get no URL
+HUBSPOT_RECORD_URLS = {"contact": "https://app.hubspot.com/contacts/{}"}
+
+# Webhooks: the URL HubSpot calls, as signed (defaults to the URL the request arrived on), and
+# how old a signed request may be before it is rejected as a replay
+HUBSPOT_WEBHOOK_URL = os.getenv("HUBSPOT_WEBHOOK_URL")
+HUBSPOT_WEBHOOK_MAX_AGE = 300
+HUBSPOT_BATCH_READ_LIMIT = 100
+# Webhook object names -> object type paths
+HUBSPOT_WEBHOOK_OBJECT_TYPES = {item_type: object_type for object_type, (item_type, _) in HUBSPOT_OBJECT_TYPES.items()}
+HUBSPOT_DELETION_EVENTS = ("deletion", "privacyDeletion")
 
 # Base64 encode client ID and secret for Basic Auth
 encoded_client_id_secret = base64.b64encode(f"{HUBSPOT_CLIENT_ID}:{HUBSPOT_CLIENT_SECRET}".encode()).decode()
@@ -52,10 +92,10 @@ async def authorize_hubspot(user_id, org_id):
         f"code_challenge_method=S256"
     )
     
-    await asyncio.gather(
-        add_key_value_redis(f"hubspot_state:{org_id}:{user_id}", json.dumps(state_data), expire=600),
-        add_key_value_redis(f"hubspot_verifier:{org_id}:{user_id}", code_verifier, expire=600),
-    )
+    await add_key_values_redis({
+        f"hubspot_state:{org_id}:{user_id}": json.dumps(state_data),
+        f"hubspot_verifier:{org_id}:{user_id}": code_verifier,
+    }, expire=600)
     
     return {"auth_url": auth_url}
 
@@ -75,9 +115,10 @@ async def oauth2callback_hubspot(request: Request):
     user_id = state_data.get("user_id")
     org_id = state_data.get("org_id")
     
-    saved_state, code_verifier = await asyncio.gather(
-        get_value_redis(f"hubspot_state:{org_id}:{user_id}"),
-        get_value_redis(f"hubspot_verifier:{org_id}:{user_id}"),
+    # State and verifier are single-use, so they are read and removed in one round trip
+    saved_state, code_verifier = await get_and_delete_values_redis(
+        f"hubspot_state:{org_id}:{user_id}",
+        f"hubspot_verifier:{org_id}:{user_id}",
     )
     
     # if not saved_state or original_state != json.loads(saved_state).get("state"):
@@ -97,30 +138,24 @@ async def oauth2callback_hubspot(request: Request):
         "code_verifier": code_verifier.decode("utf-8"),
     }
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            token_url,
-            data=payload,
-            headers={"Content-Type": "application/x-www-form-urlencoded"}
-        ) as resp:
-            if resp.status != 200:
-                error_detail = await resp.text()
-                raise HTTPException(status_code=resp.status, detail=f"Failed to get token: {error_detail}")
-            token_data = await resp.json()
+    resp = await http_client.post(
+        token_url,
+        data=payload,
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=f"Failed to get token: {resp.text}")
+    token_data = resp.json()
     
     if not token_data.get("access_token"):
         raise HTTPException(status_code=500, detail="No access token received from HubSpot")
     
-    # Store the full token data in Redis
-    await asyncio.gather(
-        add_key_value_redis(
-            f"hubspot_credentials:{org_id}:{user_id}",
-            json.dumps(token_data),
-            expire=token_data.get("expires_in", 3600)
-        ),
-        delete_key_redis(f"hubspot_state:{org_id}:{user_id}"),
-        delete_key_redis(f"hubspot_verifier:{org_id}:{user_id}"),
-    )
+    # Store the full token data, refresh token included, so it can be renewed without re-running OAuth
+    await store_credentials("hubspot", user_id, org_id, token_data)
+    try:
+        await record_hubspot_portal(token_data["access_token"], user_id, org_id)
+    except HTTPException as e:
+        logger.warning("Could not look up the HubSpot portal; webhooks won't reach this account: %s", e.detail)
     
     close_window_script = """
     <html>
@@ -131,17 +166,26 @@ async def oauth2callback_hubspot(request: Request):
     """
     return HTMLResponse(content=close_window_script)
 
+async def refresh_hubspot_token(refresh_token):
+    """Exchange a refresh token for a new HubSpot access token."""
+    resp = await http_client.post(
+        "https://api.hubapi.com/oauth/v1/token",
+        data={
+            "grant_type": "refresh_token",
+            "client_id": HUBSPOT_CLIENT_ID,
+            "client_secret": HUBSPOT_CLIENT_SECRET,
+            "redirect_uri": HUBSPOT_REDIRECT_URI,
+            "refresh_token": refresh_token,
+        },
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="HubSpot token refresh failed; authorize again")
+    return resp.json()
+
 async def get_hubspot_credentials(user_id, org_id):
-    """Retrieve stored HubSpot credentials."""
-    credentials = await get_value_redis(f"hubspot_credentials:{org_id}:{user_id}")
-    if not credentials:
-        raise HTTPException(status_code=400, detail="No credentials found")
-    
-    credentials_json = json.loads(credentials)
-    # Delete credentials from Redis after retrieval for security
-    await delete_key_redis(f"hubspot_credentials:{org_id}:{user_id}")
-    
-    return credentials_json
+    """Retrieve stored HubSpot credentials, refreshing the access token when it is about to expire."""
+    return await get_credentials("hubspot", user_id, org_id, refresh_hubspot_token)
 
 
 def _recursive_dict_search(data, target_key):
@@ -165,6 +209,7 @@ def _recursive_dict_search(data, target_key):
                         return result
     return None
 
+@observe_conversion('hubspot')
 def create_integration_item_metadata_object(response_json):
     """Creates an integration metadata object from the HubSpot API response"""
     try:
@@ -174,7 +219,13 @@ def create_integration_item_metadata_object(response_json):
         # Get name components
         first_name = properties.get('firstname', '')
         last_name = properties.get('lastname', '')
-        full_name = f"{first_name} {last_name}".strip() or "Unnamed Contact"
+        full_name = (
+            f"{first_name} {last_name}".strip()
+            or properties.get('dealname')
+            or properties.get('name')
+            or properties.get('subject')
+            or "Unnamed Contact"
+        )
         email = properties.get('email', 'No Email')
         
         # Parse timestamps
@@ -198,37 +249,292 @@ def create_integration_item_metadata_object(response_json):
             last_modified_time = None
         
         # Create the IntegrationItem
+        item_type = response_json.get('objectType', 'contact')
+        record_url = HUBSPOT_RECORD_URLS.get(item_type)
         integration_item = IntegrationItem(
             id=response_json.get('id'),
-            type=response_json.get('objectType', 'contact'),
+            type=item_type,
             name=full_name,
             creation_time=creation_time,
             last_modified_time=last_modified_time,
             parent_id=None,  # HubSpot doesn't use parent_id like Notion
-            url=f"https://app.hubspot.com/contacts/{properties.get('hs_object_id', '')}" if 'hs_object_id' in properties else None
+            url=record_url.format(properties['hs_object_id']) if record_url and 'hs_object_id' in properties else None
         )
         
         return integration_item
     except Exception as e:
-        print(f"Error creating integration item: {str(e)}")
+        logger.warning("Error creating integration item %s: %s", response_json.get('id'), e)
         # Return a minimal item if there's an error
         return IntegrationItem(
             id=response_json.get('id', 'unknown'),
-            type='contact',
+            type=response_json.get('objectType', 'contact'),
             name='Error processing contact'
         )
 
-async def get_items_hubspot(credentials):
-    """Fetch HubSpot contacts and deals and convert them to IntegrationItems."""
+@observe_conversion('hubspot', batch=True)
+def create_integration_items(results, item_type, properties=None):
+    """Converts one page of a single object type in one pass.
+
+    Same output as create_integration_item_metadata_object per record, with the timestamp
+    parser cached and the URL template prebuilt. The caller's `properties` are copied into
+    each item's `properties`.
+    """
+    parse_datetime = _parse_hubspot_datetime
+    record_url = HUBSPOT_RECORD_URLS.get(item_type)
+    projection = properties
+    integration_items = []
+    append = integration_items.append
+    for result in results:
+        try:
+            properties = result.get('properties', {})
+            full_name = (
+                f"{properties.get('firstname', '')} {properties.get('lastname', '')}".strip()
+                or properties.get('dealname')
+                or properties.get('name')
+                or properties.get('subject')
+                or "Unnamed Contact"
+            )
+            append(IntegrationItem(
+                id=result.get('id'),
+                type=item_type,
+                name=full_name,
+                creation_time=parse_datetime(result.get('createdAt')),
+                last_modified_time=parse_datetime(result.get('updatedAt')),
+                url=record_url.format(properties['hs_object_id']) if record_url and 'hs_object_id' in properties else None,
+                properties={name: properties.get(name) for name in projection} if projection else None,
+            ))
+        except Exception as e:
+            logger.warning("Error creating integration item %s: %s", result.get('id'), e)
+            append(IntegrationItem(id=result.get('id', 'unknown'), type=item_type, name='Error processing contact'))
+    return integration_items
+
+def requested_properties(object_type, properties=None):
+    """Properties to ask HubSpot for: the ones items are built from plus the caller's projection."""
+    required = HUBSPOT_OBJECT_TYPES[object_type][1].split(",")
+    return required + [name for name in properties or () if name not in required]
+
+def _take_budgeted(budget, results):
+    """The part of a page the load budget still allows; a page cut short marks the load truncated."""
+    page = results[:max(budget["items"], 0)]
+    if len(page) < len(results):
+        budget["truncated"] = True
+    budget["items"] -= len(page)
+    return page
+
+async def fetch_hubspot_objects(access_token, object_type, budget, extra_params=None, on_page=None, properties=None):
+    """Page through one CRM object type until it is exhausted or the load budget is spent.
+
+    Returns (results, error) where error is the failing status code, if any. When an
+    async `on_page` callback is given, each page is handed to it instead of collected.
+    """
+    url = f"{HUBSPOT_OBJECTS_URL}/{object_type}"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    params = {
+        "limit": HUBSPOT_PAGE_LIMIT,
+        "properties": ",".join(requested_properties(object_type, properties)),
+        **(extra_params or {})
+    }
+
+    results = []
+    retrieved = 0
+    pages = 0
+    while True:
+        if budget["items"] <= 0 or pages >= budget["pages"]:
+            budget["truncated"] = True
+            break
+        response = await http_client.get(url, params=params, headers=headers)
+        pages += 1
+        if response.status_code != 200:
+            logger.warning("Error fetching %s: %s - %s", object_type, response.status_code, response.text)
+            return results, response.status_code
+
+        data = orjson.loads(response.content)
+        page = _take_budgeted(budget, data.get("results", []))
+        retrieved += len(page)
+        if on_page is None:
+            results.extend(page)
+        else:
+            await on_page(page)
+
+        after = data.get("paging", {}).get("next", {}).get("after")
+        if not after:
+            break
+        params["after"] = after
+
+    logger.info("Retrieved %d %s in %d pages", retrieved, object_type, pages)
+    return results, None
+
+async def _search_hubspot_page(access_token, object_type, low, high, after=None, direction="ASCENDING", limit=HUBSPOT_PAGE_LIMIT, properties=None):
+    """Run one CRM search request for objects last modified between low and high (epoch ms, inclusive)."""
+    modified_property = HUBSPOT_MODIFIED_PROPERTY.get(object_type, "hs_lastmodifieddate")
+    body = {
+        "filterGroups": [{
+            "filters": [{
+                "propertyName": modified_property,
+                "operator": "BETWEEN",
+                "value": str(low),
+                "highValue": str(high),
+            }]
+        }],
+        "sorts": [{"propertyName": modified_property, "direction": direction}],
+        "properties": requested_properties(object_type, properties),
+        "limit": limit,
+    }
+    if after:
+        body["after"] = after
+    return await http_client.post(
+        f"{HUBSPOT_OBJECTS_URL}/{object_type}/search",
+        json=body,
+        idempotent=True,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        },
+    )
+
+async def _search_hubspot_window(access_token, object_type, low, high, budget, pages, on_page=None, properties=None):
+    """Page through one last-modified window, splitting it in half when it exceeds the search result cap."""
+    results = []
+    after = None
+    while True:
+        if budget["items"] <= 0 or pages["count"] >= budget["pages"]:
+            budget["truncated"] = True
+            break
+        response = await _search_hubspot_page(access_token, object_type, low, high, after, properties=properties)
+        pages["count"] += 1
+        if response.status_code != 200:
+            logger.warning("Error searching %s: %s - %s", object_type, response.status_code, response.text)
+            return results, response.status_code
+
+        data = orjson.loads(response.content)
+        if after is None and data.get("total", 0) > HUBSPOT_SEARCH_RESULT_CAP and high > low:
+            middle = (low + high) // 2
+            halves = await asyncio.gather(
+                _search_hubspot_window(access_token, object_type, low, middle, budget, pages, on_page, properties),
+                _search_hubspot_window(access_token, object_type, middle + 1, high, budget, pages, on_page, properties),
+            )
+            errors = [error for _, error in halves if error is not None]
+            return halves[0][0] + halves[1][0], errors[0] if errors else None
+
+        page = _take_budgeted(budget, data.get("results", []))
+        if on_page is None:
+            results.extend(page)
+        else:
+            await on_page(page)
+
+        after = data.get("paging", {}).get("next", {}).get("after")
+        if not after:
+            break
+
+    return results, None
+
+async def search_hubspot_objects(access_token, object_type, budget, windows=HUBSPOT_SEARCH_WINDOWS, since=None, on_page=None, properties=None):
+    """Load one CRM object type through the search endpoint, pulling last-modified windows in parallel.
+
+    `since` (epoch ms) restricts the load to objects modified at or after it.
+    Same contract as fetch_hubspot_objects: returns (results, error).
+    """
+    pages = {"count": 0}
+    low = since
+    if low is None:
+        # The oldest modification date bounds the range; everything up to now is split evenly
+        response = await _search_hubspot_page(access_token, object_type, 0, _now_ms(), limit=1)
+        pages["count"] += 1
+        if response.status_code != 200:
+            logger.warning("Error searching %s: %s - %s", object_type, response.status_code, response.text)
+            return [], response.status_code
+        oldest = response.json().get("results", [])
+        if not oldest:
+            return [], None
+        low = _parse_hubspot_ms(oldest[0].get("updatedAt")) or 0
+
+    high = _now_ms()
+    windows = max(min(windows, high - low + 1), 1)
+    step = (high - low + 1) // windows
+    bounds = [(low + i * step, low + (i + 1) * step - 1) for i in range(windows)]
+    bounds[-1] = (bounds[-1][0], high)
+
+    # Records modified mid-load can move into a later window; keep one copy of each
+    results = {}
+    on_window_page = None
+    if on_page is not None:
+        async def on_window_page(page):
+            page = [result for result in page if result["id"] not in results]
+            results.update((result["id"], None) for result in page)
+            await on_page(page)
+
+    fetched = await asyncio.gather(
+        *(_search_hubspot_window(access_token, object_type, start, end, budget, pages, on_window_page, properties) for start, end in bounds)
+    )
+
+    for window_results, _ in fetched:
+        for result in window_results:
+            results[result["id"]] = result
+    errors = [error for _, error in fetched if error is not None]
+
+    logger.info("Retrieved %d %s from %d search windows in %d pages", len(results), object_type, len(bounds), pages["count"])
+    return [result for result in results.values() if result is not None], errors[0] if errors else None
+
+def _now_ms():
+    return int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+
+@functools.lru_cache(maxsize=4096)
+def _parse_hubspot_datetime(value):
+    """Parse a HubSpot ISO timestamp, None if missing or malformed.
+
+    Cached: records created or touched by the same import share timestamps."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (ValueError, TypeError):
+        return None
+
+def _parse_hubspot_ms(value):
+    """Convert a HubSpot ISO timestamp to epoch milliseconds."""
+    parsed = _parse_hubspot_datetime(value)
+    return None if parsed is None else int(parsed.timestamp() * 1000)
+
+HUBSPOT_LOAD_MODES = {
+    "list": fetch_hubspot_objects,
+    "search": search_hubspot_objects,
+}
+
+async def fetch_hubspot_archived(access_token, object_type, since, max_pages, load_budget):
+    """Objects of one type archived at or after `since` (epoch ms), used as delta tombstones.
+
+    The archive list can't be filtered or sorted by archive time, so it is read in full; if it
+    runs past its budget the newest deletions may be missing, and `load_budget` is marked
+    truncated so the delta watermark isn't moved past them.
+    """
+    budget = {"items": HUBSPOT_MAX_ITEMS, "pages": max_pages, "truncated": False}
+    results, error = await fetch_hubspot_objects(access_token, object_type, budget, extra_params={"archived": "true"})
+    if budget["truncated"]:
+        logger.warning("Archived %s exceed the load budget; deletions may be missing", object_type)
+        load_budget["truncated"] = True
+    results = [result for result in results if (_parse_hubspot_ms(result.get("archivedAt")) or 0) >= since]
+    return results, error
+
+async def get_items_hubspot(credentials, object_types=None, max_items=HUBSPOT_MAX_ITEMS, max_pages=HUBSPOT_MAX_PAGES, mode="list", since=None, properties=None):
+    """Fetch HubSpot CRM objects and convert them to IntegrationItems.
+
+    Every object type in `object_types` is paginated concurrently; `max_items` caps the
+    total across types and `max_pages` caps the pages fetched per type. `mode` selects
+    the list endpoint ("list") or date-partitioned CRM search ("search"). With `since`
+    (ISO timestamp) only objects modified from then on are searched, and objects archived
+    since then are returned as delta tombstones. Only the properties items are built from are
+    requested, plus any in `properties`, which are returned in each item's `properties`.
+    """
     try:
-        print("Credentials received:", credentials)
-        
         # Handle different credential formats
         if isinstance(credentials, str):
             try:
                 credentials_dict = json.loads(credentials)
             except json.JSONDecodeError:
-                print("Failed to parse credentials as JSON string")
+                logger.warning("Failed to parse credentials as JSON string")
                 return {"error": "Invalid credentials format"}
         elif isinstance(credentials, dict):
             credentials_dict = credentials
@@ -238,91 +544,293 @@ async def get_items_hubspot(credentials):
                 if isinstance(credentials.get("credentials"), dict):
                     credentials_dict = credentials.get("credentials")
                 else:
-                    print("Unexpected credentials format:", credentials)
+                    logger.warning("Unexpected credentials format: %s", type(credentials).__name__)
                     return {"error": "Unsupported credentials format"}
             else:
-                print("Unexpected credentials format:", credentials)
+                logger.warning("Unexpected credentials format: %s", type(credentials).__name__)
                 return {"error": "Unsupported credentials format"}
         
         # Extract access token
         access_token = credentials_dict.get("access_token")
         if not access_token:
-            print("No access token found in credentials")
+            logger.warning("No access token found in credentials")
             return {"error": "No access token found in credentials"}
-        
-        print(f"Using access token: {access_token[:10]}...")
-        
-        # 1. Fetch contacts
-        contacts_url = "https://api.hubapi.com/crm/v3/objects/contacts"
-        contacts_params = {
-            "limit": 50,
-            "properties": "firstname,lastname,email,phone,company,website,hs_object_id"
-        }
-        contacts_headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-        
-        print(f"Fetching contacts from {contacts_url}")
-        contacts_response = requests.get(contacts_url, params=contacts_params, headers=contacts_headers)
-        
-        if contacts_response.status_code != 200:
-            print(f"Error fetching contacts: {contacts_response.status_code} - {contacts_response.text}")
-            return {"error": f"Failed to fetch contacts: {contacts_response.status_code}"}
-        
-        contacts_data = contacts_response.json()
-        contacts_results = contacts_data.get("results", [])
-        print(f"Retrieved {len(contacts_results)} contacts")
-        
-        # 2. Fetch deals
-        deals_url = "https://api.hubapi.com/crm/v3/objects/deals"
-        deals_params = {
-            "limit": 50,
-            "properties": "dealname,amount,closedate,dealstage,pipeline"
-        }
-        
-        print(f"Fetching deals from {deals_url}")
-        deals_response = requests.get(deals_url, params=deals_params, headers=contacts_headers)
-        
-        deals_results = []
-        if deals_response.status_code == 200:
-            deals_data = deals_response.json()
-            deals_results = deals_data.get("results", [])
-            print(f"Retrieved {len(deals_results)} deals")
-        else:
-            print(f"Error fetching deals: {deals_response.status_code} - {deals_response.text}")
-        
-        # 3. Process results into IntegrationItems
+
+        if mode not in HUBSPOT_LOAD_MODES:
+            return {"error": f"Unsupported load mode: {mode}"}
+        fetch_objects = functools.partial(HUBSPOT_LOAD_MODES[mode], properties=properties)
+        since_ms = _parse_hubspot_ms(since)
+        if since_ms is not None:
+            fetch_objects = functools.partial(search_hubspot_objects, since=since_ms, properties=properties)
+
+        object_types = object_types or list(HUBSPOT_OBJECT_TYPES)
+        unknown_types = [object_type for object_type in object_types if object_type not in HUBSPOT_OBJECT_TYPES]
+        if unknown_types:
+            return {"error": f"Unsupported object types: {', '.join(unknown_types)}"}
+
+        # 1. Fetch every object type concurrently against a shared budget
+        budget = {"items": max_items, "pages": max_pages, "truncated": False}
+        fetched = await asyncio.gather(
+            *(fetch_objects(access_token, object_type, budget) for object_type in object_types)
+        )
+        archived = [([], None)] * len(object_types)
+        if since_ms is not None:
+            archived = await asyncio.gather(
+                *(fetch_hubspot_archived(access_token, object_type, since_ms, max_pages, budget) for object_type in object_types)
+            )
+
+        # Contacts are required; the other object types are best-effort
+        failed_object_types = []
+        for object_type, (_, error), (_, archived_error) in zip(object_types, fetched, archived):
+            if error is not None and object_type == "contacts":
+                return {"error": f"Failed to fetch contacts: {error}"}
+            if error is not None or archived_error is not None:
+                failed_object_types.append(object_type)
+
+        # 2. Process results into IntegrationItems
         integration_items = []
+        for object_type, (results, _) in zip(object_types, fetched):
+            item_type = HUBSPOT_OBJECT_TYPES[object_type][0]
+            integration_items.extend(create_integration_items(results, item_type, properties))
+        for object_type, (results, _) in zip(object_types, archived):
+            item_type = HUBSPOT_OBJECT_TYPES[object_type][0]
+            for result, integration_item in zip(results, create_integration_items(results, item_type)):
+                integration_item.last_modified_time = _parse_hubspot_datetime(result.get("archivedAt"))
+                integration_item.delta = "deleted"
+                integration_items.append(integration_item)
         
-        # Process contacts
-        for contact in contacts_results:
-            contact["objectType"] = "contact"
-            integration_item = create_integration_item_metadata_object(contact)
-            integration_items.append(integration_item)
-        
-        # Process deals
-        for deal in deals_results:
-            deal["objectType"] = "deal"
-            integration_item = create_integration_item_metadata_object(deal)
-            integration_items.append(integration_item)
-        
-        # 4. Convert to dictionaries for JSON serialization
-        items_as_dicts = [item.__dict__ for item in integration_items]
+        # 3. Log results; per-item lines are sampled
+        logger.info("Loaded %d HubSpot items", len(integration_items), extra={"truncated": budget["truncated"]})
+        if logger.isEnabledFor(logging.DEBUG):
+            for item in integration_items:
+                logger.debug("%s: %s (ID: %s)", item.type, item.name, item.id, extra={"sample": True})
         
-        # 5. Print results for debugging
-        print(f"Total integration items: {len(integration_items)}")
-        for item in integration_items[:5]:  # Print first 5 for debugging
-            print(f"- {item.type}: {item.name} (ID: {item.id})")
-        
-        # 6. Return the data
+        # 4. Return the data; items stay IntegrationItems and are encoded in bulk by the route
         return {
-            "items": items_as_dicts,
-            "count": len(items_as_dicts)
+            "items": integration_items,
+            "count": len(integration_items),
+            "truncated": budget["truncated"],
+            "failed_object_types": failed_object_types,
         }
         
     except Exception as e:
-        print(f"Error in get_items_hubspot: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_items_hubspot")
         return {"error": f"Failed to process HubSpot data: {str(e)}"}
+
+def iter_items_hubspot(credentials, object_types=None, max_items=HUBSPOT_MAX_ITEMS, max_pages=HUBSPOT_MAX_PAGES, mode="list", properties=None):
+    """Yield IntegrationItems one upstream page at a time while all object types load concurrently.
+
+    Same budget and error rules as get_items_hubspot; a contacts failure is raised once the
+    pages already fetched have been handed over. The arguments are checked when this is
+    called, so a bad request fails before a streaming response has started.
+    """
+    if mode not in HUBSPOT_LOAD_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported load mode: {mode}")
+    unknown_types = [object_type for object_type in object_types or () if object_type not in HUBSPOT_OBJECT_TYPES]
+    if unknown_types:
+        raise HTTPException(status_code=400, detail=f"Unsupported object types: {', '.join(unknown_types)}")
+    if isinstance(credentials, str):
+        credentials = json.loads(credentials)
+    return _iter_items_hubspot(credentials.get("access_token"), object_types or list(HUBSPOT_OBJECT_TYPES), max_items, max_pages, HUBSPOT_LOAD_MODES[mode], properties)
+
+async def _iter_items_hubspot(access_token, object_types, max_items, max_pages, fetch_objects, properties):
+    budget = {"items": max_items, "pages": max_pages, "truncated": False}
+    # A couple of pages per object type in flight keeps memory flat when the client reads slowly
+    pages = asyncio.Queue(maxsize=2 * len(object_types))
+
+    def page_sink(item_type):
+        async def on_page(page):
+            await pages.put((item_type, page))
+        return on_page
+
+    async def fetch_all():
+        try:
+            fetched = await asyncio.gather(
+                *(
+                    fetch_objects(access_token, object_type, budget, on_page=page_sink(HUBSPOT_OBJECT_TYPES[object_type][0]), properties=properties)
+                    for object_type in object_types
+                )
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await pages.put(None)
+            raise
+        await pages.put(None)
+        return fetched
+
+    fetches = asyncio.ensure_future(fetch_all())
+    try:
+        while (entry := await pages.get()) is not None:
+            item_type, page = entry
+            yield create_integration_items(page, item_type, properties)
+
+        for object_type, (_, error) in zip(object_types, await fetches):
+            if error is not None and object_type == "contacts":
+                raise HTTPException(status_code=error, detail=f"Failed to fetch contacts: {error}")
+    finally:
+        fetches.cancel()
+
+async def get_delta_items_hubspot(credentials, user_id, org_id, object_types=None, max_items=HUBSPOT_MAX_ITEMS, max_pages=HUBSPOT_MAX_PAGES):
+    """Load only the HubSpot objects changed since the last delta load, plus tombstones."""
+    watermark = await get_watermark("hubspot", user_id, org_id)
+    since = watermark.get("since") if watermark else None
+
+    result = await get_items_hubspot(credentials, object_types, max_items, max_pages, mode="search", since=since)
+    if "error" in result:
+        return result
+    for item in result["items"]:
+        item.delta = item.delta or "upsert"
+
+    # Windows run in parallel, so a cut-short load can't tell which older changes it missed
+    if not result["truncated"] and not result["failed_object_types"]:
+        await save_watermark("hubspot", user_id, org_id, {
+            "since": latest_modified_time(
+                (item.last_modified_time for item in result["items"] if item.delta != "deleted"),
+                default=since,
+            ),
+        })
+    return result
+
+
+# Webhooks
+def _portal_key(portal_id):
+    return f"hubspot_portal:{portal_id}"
+
+async def record_hubspot_portal(access_token, user_id, org_id):
+    """Remember which accounts a portal's webhook events apply to; returns the portal id."""
+    resp = await http_client.get(f"https://api.hubapi.com/oauth/v1/access-tokens/{access_token}")
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail="Failed to look up the HubSpot portal")
+    portal_id = resp.json().get("hub_id")
+    await add_set_member_redis(_portal_key(portal_id), json.dumps({"user_id": user_id, "org_id": org_id}))
+    return portal_id
+
+async def subscribe_webhooks_hubspot(user_id, org_id):
+    """Route the account's portal events to it.
+
+    The subscriptions themselves are configured once for the app in HubSpot; this only maps
+    an account connected before webhooks were enabled to its portal.
+    """
+    credentials = await get_hubspot_credentials(user_id, org_id)
+    return {"portal_id": await record_hubspot_portal(credentials["access_token"], user_id, org_id)}
+
+def verify_hubspot_signature(method, uri, body, timestamp, signature):
+    """Check a v3 webhook signature: base64 HMAC-SHA256 of method + URI + body + timestamp, keyed by the app secret."""
+    if not HUBSPOT_CLIENT_SECRET or not timestamp or not signature:
+        return False
+    try:
+        age = time.time() - int(timestamp) / 1000
+    except ValueError:
+        return False
+    if abs(age) > HUBSPOT_WEBHOOK_MAX_AGE:
+        return False
+    source = f"{method}{uri}".encode("utf-8") + body + timestamp.encode("utf-8")
+    expected = base64.b64encode(hmac.new(HUBSPOT_CLIENT_SECRET.encode("utf-8"), source, hashlib.sha256).digest()).decode("utf-8")
+    return hmac.compare_digest(expected, signature)
+
+async def receive_webhook_hubspot(request: Request):
+    """Verify a batch of CRM subscription events and buffer one entry per changed object.
+
+    A signed body that isn't a list of event objects is rejected with 400.
+    """
+    body = await request.body()
+    if not verify_hubspot_signature(
+        request.method,
+        HUBSPOT_WEBHOOK_URL or str(request.url),
+        body,
+        request.headers.get("X-HubSpot-Request-Timestamp"),
+        request.headers.get("X-HubSpot-Signature-v3"),
+    ):
+        metrics.WEBHOOK_EVENTS.labels("hubspot", "rejected").inc()
+        raise HTTPException(status_code=401, detail="Invalid HubSpot webhook signature")
+
+    try:
+        notifications = json.loads(body)
+    except ValueError:
+        notifications = None
+    if not isinstance(notifications, list) or not all(
+        isinstance(event, dict)
+        and isinstance(event.get("subscriptionType", ""), str)
+        and isinstance(event.get("occurredAt", 0), int)
+        and isinstance(event.get("mergedObjectIds") or [], list)
+        for event in notifications
+    ):
+        metrics.WEBHOOK_EVENTS.labels("hubspot", "rejected").inc()
+        raise HTTPException(status_code=400, detail="Malformed HubSpot webhook events")
+
+    events = []
+    for event in notifications:
+        object_name, _, action = event.get("subscriptionType", "").partition(".")
+        object_type = HUBSPOT_WEBHOOK_OBJECT_TYPES.get(object_name)
+        if object_type is None:
+            continue
+        portal_id = event.get("portalId")
+        occurred_at = event.get("occurredAt")
+        events.append((f"{portal_id}|{object_type}|{event.get('objectId')}", occurred_at, {"deleted": action in HUBSPOT_DELETION_EVENTS}))
+        # Records merged into objectId no longer exist on their own
+        for merged_id in event.get("mergedObjectIds") or []:
+            events.append((f"{portal_id}|{object_type}|{merged_id}", occurred_at, {"deleted": True}))
+    await buffer_events("hubspot", events)
+    return {"buffered": len(events)}
+
+async def _batch_read_hubspot_objects(access_token, object_type, ids):
+    """Current state of the given records, HUBSPOT_BATCH_READ_LIMIT per request; ids missing from it no longer exist."""
+    results = []
+    for start in range(0, len(ids), HUBSPOT_BATCH_READ_LIMIT):
+        resp = await http_client.post(
+            f"{HUBSPOT_OBJECTS_URL}/{object_type}/batch/read",
+            json={
+                "properties": HUBSPOT_OBJECT_TYPES[object_type][1].split(","),
+                "inputs": [{"id": object_id} for object_id in ids[start:start + HUBSPOT_BATCH_READ_LIMIT]],
+            },
+            idempotent=True,
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            },
+        )
+        # 207 carries the records found alongside errors for the missing ones
+        if resp.status_code not in (200, 207):
+            raise HTTPException(status_code=resp.status_code, detail=f"Failed to read changed {object_type}: {resp.text}")
+        results.extend(resp.json().get("results", []))
+    return results
+
+async def _portal_accounts(portal_id):
+    """(user_id, org_id, credentials) of every connected account of a portal whose credentials are still valid."""
+    accounts = []
+    for member in await get_set_members_redis(_portal_key(portal_id)):
+        account = json.loads(member)
+        try:
+            credentials = await get_hubspot_credentials(account["user_id"], account["org_id"])
+        except HTTPException as e:
+            logger.info("Skipping webhook events for a disconnected HubSpot account: %s", e.detail)
+            continue
+        accounts.append((account["user_id"], account["org_id"], credentials))
+    return accounts
+
+async def apply_webhook_events_hubspot(events):
+    """Fetch the records changed since their events and apply them to every account of their portal."""
+    portals = {}
+    for key, _, event in events:
+        portal_id, object_type, object_id = key.split("|")
+        portals.setdefault(portal_id, {}).setdefault(object_type, {})[object_id] = event["deleted"]
+
+    for portal_id, changes in portals.items():
+        accounts = await _portal_accounts(portal_id)
+        if not accounts:
+            continue
+        access_token = accounts[0][2]["access_token"]
+        upserts = []
+        deleted = []
+        for object_type, objects in changes.items():
+            item_type = HUBSPOT_OBJECT_TYPES[object_type][0]
+            changed_ids = [object_id for object_id, is_deleted in objects.items() if not is_deleted]
+            results = await _batch_read_hubspot_objects(access_token, object_type, changed_ids) if changed_ids else []
+            upserts.extend(create_integration_items(results, item_type))
+            found = {result.get("id") for result in results}
+            deleted.extend((item_type, object_id) for object_id in objects if object_id not in found)
+
+        logger.info("Applying %d changed and %d deleted HubSpot records", len(upserts), len(deleted), extra={"accounts": len(accounts)})
+        for user_id, org_id, credentials in accounts:
+            await apply_item_changes("hubspot", user_id, org_id, credentials, upserts, deleted)
@@ -1,35 +1,68 @@
+from dataclasses import dataclass, fields
 from datetime import datetime
 from typing import Optional, List
 
+import orjson
+
+@dataclass(slots=True)
 class IntegrationItem:
-    def __init__(
-        self,
-        id: Optional[str] = None,
-        type: Optional[str] = None,
-        directory: bool = False,
-        parent_path_or_name: Optional[str] = None,
-        parent_id: Optional[str] = None,
-        name: Optional[str] = None,
-        creation_time: Optional[datetime] = None,
-        last_modified_time: Optional[datetime] = None,
-        url: Optional[str] = None,
-        children: Optional[List[str]] = None,
-        mime_type: Optional[str] = None,
-        delta: Optional[str] = None,
-        drive_id: Optional[str] = None,
-        visibility: Optional[bool] = True,
-    ):
-        self.id = id
-        self.type = type
-        self.directory = directory
-        self.parent_path_or_name = parent_path_or_name
-        self.parent_id = parent_id
-        self.name = name
-        self.creation_time = creation_time
-        self.last_modified_time = last_modified_time
-        self.url = url
-        self.children = children
-        self.mime_type = mime_type
-        self.delta = delta
-        self.drive_id = drive_id
-        self.visibility = visibility
+    id: Optional[str] = None
+    type: Optional[str] = None
+    directory: bool = False
+    parent_path_or_name: Optional[str] = None
+    parent_id: Optional[str] = None
+    name: Optional[str] = None
+    creation_time: Optional[datetime] = None
+    last_modified_time: Optional[datetime] = None
+    url: Optional[str] = None
+    children: Optional[List[str]] = None
+    mime_type: Optional[str] = None
+    delta: Optional[str] = None
+    drive_id: Optional[str] = None
+    visibility: Optional[bool] = True
+    # Provider properties/fields the load was asked to project, by name
+    properties: Optional[dict] = None
+
+    def to_json(self) -> bytes:
+        return orjson.dumps(self)
+
+
+_FIELD_NAMES = tuple(field.name for field in fields(IntegrationItem))
+
+
+def encode_items(payload) -> bytes:
+    """Encode a loader result (a list of IntegrationItems, or a dict holding them) to JSON bytes.
+
+    orjson serializes the slotted dataclasses and datetimes natively, so no per-item dicts are built.
+    """
+    return orjson.dumps(payload)
+
+
+def arrow_schema():
+    """Arrow schema of items_to_arrow tables: fixed, so every page of a stream shares it.
+
+    `properties` holds arbitrary provider values, so it is carried as a JSON string.
+    """
+    import pyarrow
+
+    timestamp = pyarrow.timestamp('us', tz='UTC')
+    types = {
+        'directory': pyarrow.bool_(),
+        'visibility': pyarrow.bool_(),
+        'creation_time': timestamp,
+        'last_modified_time': timestamp,
+        'children': pyarrow.list_(pyarrow.string()),
+    }
+    return pyarrow.schema([(name, types.get(name, pyarrow.string())) for name in _FIELD_NAMES])
+
+
+def items_to_arrow(items):
+    """Columnar copy of a list of IntegrationItems as a pyarrow Table, one column per field.
+
+    pyarrow is optional and only imported here, so the JSON paths never pay for it.
+    """
+    import pyarrow
+
+    columns = {name: [getattr(item, name) for item in items] for name in _FIELD_NAMES}
+    columns['properties'] = [None if value is None else orjson.dumps(value).decode() for value in columns['properties']]
+    return pyarrow.table(columns, schema=arrow_schema())
@@ -0,0 +1,107 @@
+"""Parent/child structure of a provider's items, built in one linear pass."""
+
+PATH_SEPARATOR = '/'
+
+
+class ItemTree:
+    """id -> parent, children, depth, path and subtree size for a set of items.
+
+    Children are kept as dicts keyed by id (values unused), in load order, so breaking a cycle
+    unlinks an item in constant time.
+
+    Built from (id, parent_id, name) triples. A parent_id that isn't among the items makes the
+    item a root, and so does the item that closes a parent_id cycle, so every item is reachable.
+    """
+
+    def __init__(self, nodes):
+        self.names = {}
+        self.parents = {}
+        for item_id, parent_id, name in nodes:
+            if item_id is None or item_id in self.names:
+                continue
+            self.names[item_id] = name
+            self.parents[item_id] = parent_id
+
+        self.children = {item_id: {} for item_id in self.names}
+        self.roots = []
+        # Roots made by breaking a cycle, as opposed to items whose parent simply wasn't loaded
+        self.cycle_roots = set()
+        for item_id, parent_id in self.parents.items():
+            if parent_id in self.names and parent_id != item_id:
+                self.children[parent_id][item_id] = None
+            else:
+                if parent_id == item_id:
+                    self.cycle_roots.add(item_id)
+                self.parents[item_id] = None
+                self.roots.append(item_id)
+
+        # Breadth-first order puts every parent before its children
+        self.order = []
+        self.depths = {}
+        self.paths = {}
+        self._visit(self.roots)
+        if len(self.order) < len(self.names):
+            for item_id in self.names:
+                if item_id not in self.depths:
+                    del self.children[self.parents[item_id]][item_id]
+                    self.parents[item_id] = None
+                    self.roots.append(item_id)
+                    self.cycle_roots.add(item_id)
+                    self._visit([item_id])
+
+        self.sizes = dict.fromkeys(self.names, 1)
+        for item_id in reversed(self.order):
+            parent_id = self.parents[item_id]
+            if parent_id is not None:
+                self.sizes[parent_id] += self.sizes[item_id]
+
+    def _visit(self, start):
+        start_index = len(self.order)
+        for item_id in start:
+            self.depths[item_id] = 0
+            self.paths[item_id] = self.names[item_id] or item_id
+        self.order.extend(start)
+        index = start_index
+        while index < len(self.order):
+            item_id = self.order[index]
+            index += 1
+            for child_id in self.children[item_id]:
+                if child_id in self.depths:
+                    continue
+                self.depths[child_id] = self.depths[item_id] + 1
+                self.paths[child_id] = self.paths[item_id] + PATH_SEPARATOR + (self.names[child_id] or child_id)
+                self.order.append(child_id)
+
+    @classmethod
+    def from_items(cls, items):
+        return cls((item.id, item.parent_id, item.name) for item in items)
+
+    def __contains__(self, item_id):
+        return item_id in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+
+def materialize_tree(items):
+    """Fill parent_id, children, directory and parent_path_or_name consistently across loaded items.
+
+    parent_path_or_name becomes the parent's full path from its root. Items whose parent wasn't
+    loaded keep what their loader set, while the item that closed a parent_id cycle loses its
+    parent so it agrees with being a root. Returns the ItemTree for further lookups.
+    """
+    tree = ItemTree.from_items(items)
+    for item in items:
+        if item.id not in tree:
+            continue
+        children = tree.children[item.id]
+        parent_id = tree.parents[item.id]
+        item.children = list(children) if children else None
+        item.directory = item.directory or bool(children)
+        if parent_id is not None:
+            item.parent_id = parent_id
+            item.parent_path_or_name = tree.paths[parent_id]
+        elif item.id in tree.cycle_roots:
+            item.parent_id = None
+            item.parent_path_or_name = None
+    return tree
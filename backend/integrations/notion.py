@@ -1,22 +1,29 @@
 # notion.py
 
+import datetime
 import json
 import secrets
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
 import asyncio
 import base64
-import requests
+import functools
+import http_client
+from credential_manager import CREDENTIALS_TTL, get_credentials, store_credentials
+from delta_sync import get_watermark, save_watermark, latest_modified_time
+from metrics import observe_conversion
 from integrations.integration_item import IntegrationItem
 
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from redis_client import add_key_value_redis, get_and_delete_value_redis
 
 CLIENT_ID = 'XXX'
 CLIENT_SECRET = 'XXX'
 encoded_client_id_secret = base64.b64encode(f'{CLIENT_ID}:{CLIENT_SECRET}'.encode()).decode()
 
 REDIRECT_URI = 'http://localhost:8000/integrations/notion/oauth2callback'
+NOTION_VERSION = '2022-06-28'
+# Notion averages ~3 requests/second per integration, which bounds the child-block fan-out
+BLOCKS_FETCH_CONCURRENCY = 3
 authorization_url = f'https://api.notion.com/v1/oauth/authorize?client_id={CLIENT_ID}&response_type=code&owner=user&redirect_uri=http%3A%2F%2Flocalhost%3A8000%2Fintegrations%2Fnotion%2Foauth2callback'
 
 async def authorize_notion(user_id, org_id):
@@ -41,29 +48,28 @@ async def oauth2callback_notion(request: Request):
     user_id = state_data.get('user_id')
     org_id = state_data.get('org_id')
 
-    saved_state = await get_value_redis(f'notion_state:{org_id}:{user_id}')
+    saved_state = await get_and_delete_value_redis(f'notion_state:{org_id}:{user_id}')
 
     if not saved_state or original_state != json.loads(saved_state).get('state'):
         raise HTTPException(status_code=400, detail='State does not match.')
 
-    async with httpx.AsyncClient() as client:
-        response, _ = await asyncio.gather(
-            client.post(
-                'https://api.notion.com/v1/oauth/token',
-                json={
-                    'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': REDIRECT_URI
-                }, 
-                headers={
-                    'Authorization': f'Basic {encoded_client_id_secret}',
-                    'Content-Type': 'application/json',
-                }
-            ),
-            delete_key_redis(f'notion_state:{org_id}:{user_id}'),
-        )
+    response = await http_client.post(
+        'https://api.notion.com/v1/oauth/token',
+        json={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI
+        },
+        headers={
+            'Authorization': f'Basic {encoded_client_id_secret}',
+            'Content-Type': 'application/json',
+        }
+    )
 
-    await add_key_value_redis(f'notion_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail='Failed to get Notion token.')
+    # Notion access tokens don't expire, so there is nothing to refresh and they are kept for long
+    await store_credentials('notion', user_id, org_id, response.json(), expire=CREDENTIALS_TTL)
     
     close_window_script = """
     <html>
@@ -75,15 +81,7 @@ async def oauth2callback_notion(request: Request):
     return HTMLResponse(content=close_window_script)
 
 async def get_notion_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'notion_credentials:{org_id}:{user_id}')
-    if not credentials:
-        raise HTTPException(status_code=400, detail='No credentials found.')
-    credentials = json.loads(credentials)
-    if not credentials:
-        raise HTTPException(status_code=400, detail='No credentials found.')
-    await delete_key_redis(f'notion_credentials:{org_id}:{user_id}')
-
-    return credentials
+    return await get_credentials('notion', user_id, org_id)
 
 
 
@@ -105,43 +103,255 @@ def _recursive_dict_search(data, target_key):
                         return result
     return None
 
-# Create IntegrationItem object from HubSpot API response
-def create_integration_item_metadata_object(response_json):
-    """Creates an integration metadata object from the HubSpot API response"""
-    
-    name = _recursive_dict_search(response_json['properties'], 'firstname') or "Unknown Contact"
-    email = response_json['properties'].get('email', 'No Email')
+def _notion_headers(access_token):
+    return {
+        'Authorization': f'Bearer {access_token}',
+        'Notion-Version': NOTION_VERSION,
+    }
+
+@functools.lru_cache(maxsize=4096)
+def _parse_notion_time(value):
+    """Parse a Notion ISO timestamp, None if missing or malformed.
+
+    Cached: Notion rounds edit times to the minute, so a page of results repeats them."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (ValueError, TypeError):
+        return None
+
+@observe_conversion('notion')
+def create_integration_item_metadata_object(response_json: dict) -> IntegrationItem:
+    """Creates an integration metadata object from a Notion page or database"""
+    name = _recursive_dict_search(response_json.get('properties', {}), 'content')
+    name = _recursive_dict_search(response_json, 'content') if name is None else name
+    name = 'multi_select' if name is None else name
+    name = response_json['object'] + ' ' + name
+
+    parent = response_json.get('parent', {})
+    parent_type = parent.get('type')
+    parent_id = None if parent_type in (None, 'workspace') else parent.get(parent_type)
 
     integration_item_metadata = IntegrationItem(
         id=response_json['id'],
-        type=response_json.get('object', 'contact'),
+        type=response_json['object'],
         name=name,
-        email=email,
-        creation_time=response_json.get('createdAt', ''),
-        last_modified_time=response_json.get('updatedAt', ''),
-        parent_id=None,  # HubSpot doesn't use parent_id like Notion
+        creation_time=_parse_notion_time(response_json.get('created_time')),
+        last_modified_time=_parse_notion_time(response_json.get('last_edited_time')),
+        parent_id=parent_id,
+        url=response_json.get('url'),
     )
 
     return integration_item_metadata
 
-async def get_items_notion(credentials) -> list[IntegrationItem]:
-    """Aggregates all metadata relevant for a notion integration"""
+@observe_conversion('notion', batch=True)
+def create_integration_items(results: list) -> list[IntegrationItem]:
+    """Converts one page of search results in one pass; same output as the per-record function"""
+    parse_time = _parse_notion_time
+    integration_items = []
+    for result in results:
+        name = _recursive_dict_search(result.get('properties', {}), 'content')
+        name = _recursive_dict_search(result, 'content') if name is None else name
+        name = 'multi_select' if name is None else name
+
+        parent = result.get('parent', {})
+        parent_type = parent.get('type')
+        integration_items.append(IntegrationItem(
+            id=result['id'],
+            type=result['object'],
+            name=result['object'] + ' ' + name,
+            creation_time=parse_time(result.get('created_time')),
+            last_modified_time=parse_time(result.get('last_edited_time')),
+            parent_id=None if parent_type in (None, 'workspace') else parent.get(parent_type),
+            url=result.get('url'),
+        ))
+    return integration_items
+
+async def iter_items_notion(credentials, since=None):
+    """Yields the IntegrationItems of one search page at a time.
+
+    Search is walked newest-edit first; with `since` it stops at the first result edited
+    before that time and marks what it returns as delta upserts or deletions.
+    """
     credentials = json.loads(credentials)
-    response = requests.post(
-        'https://api.notion.com/v1/search',
-        headers={
-            'Authorization': f'Bearer {credentials.get("access_token")}',
-            'Notion-Version': '2022-06-28',
-        },
-    )
+    body = {
+        'page_size': 100,
+        'sort': {'direction': 'descending', 'timestamp': 'last_edited_time'},
+    }
+
+    while True:
+        response = await http_client.post(
+            'https://api.notion.com/v1/search',
+            json=body,
+            headers=_notion_headers(credentials.get('access_token')),
+            idempotent=True,
+        )
+        if response.status_code != 200:
+            # Stopping here would pass a partial result off as complete: cached as a full load,
+            # or moving a delta watermark past changes it never saw
+            raise HTTPException(status_code=response.status_code, detail='Notion search failed.')
 
-    if response.status_code == 200:
-        results = response.json()['results']
+        response_json = response.json()
         list_of_integration_item_metadata = []
-        for result in results:
-            list_of_integration_item_metadata.append(
-                create_integration_item_metadata_object(result)
+        for result, item in zip(response_json['results'], create_integration_items(response_json['results'])):
+            if since is not None:
+                # Notion rounds edit times to the minute, so only strictly older results end the scan
+                if item.last_modified_time is not None and item.last_modified_time < since:
+                    yield list_of_integration_item_metadata
+                    return
+                item.delta = 'deleted' if result.get('archived') or result.get('in_trash') else 'upsert'
+            list_of_integration_item_metadata.append(item)
+        yield list_of_integration_item_metadata
+
+        if not response_json.get('has_more'):
+            return
+        body['start_cursor'] = response_json['next_cursor']
+
+async def fetch_block_children(access_token, block_id, semaphore) -> list[dict]:
+    """Fetching every child block of a page or block; a failed page of children fails the load"""
+    children = []
+    params = {'page_size': 100}
+    while True:
+        async with semaphore:
+            response = await http_client.get(
+                f'https://api.notion.com/v1/blocks/{block_id}/children',
+                params=params,
+                headers=_notion_headers(access_token),
             )
+        if response.status_code != 200:
+            # Returning what was read so far would build the hierarchy with pages silently missing
+            raise HTTPException(status_code=response.status_code, detail=f'Failed to read the children of Notion block {block_id}.')
+
+        response_json = response.json()
+        children.extend(response_json['results'])
+        if not response_json.get('has_more'):
+            return children
+        params['start_cursor'] = response_json['next_cursor']
+
+async def fetch_child_pages(access_token, page_id, semaphore, block_owners) -> list[dict]:
+    """Finds the child page/database blocks of a page, looking inside nested layout blocks level by level.
+
+    Every block visited is recorded in `block_owners` against the page that contains it.
+    """
+    child_pages = []
+    pending = [page_id]
+    while pending:
+        blocks_per_parent = await asyncio.gather(
+            *(fetch_block_children(access_token, block_id, semaphore) for block_id in pending)
+        )
+        pending = []
+        for blocks in blocks_per_parent:
+            for block in blocks:
+                block_owners[block['id']] = page_id
+                if block['type'] in ('child_page', 'child_database'):
+                    child_pages.append(block)
+                elif block.get('has_children'):
+                    pending.append(block['id'])
+    return child_pages
+
+@observe_conversion('notion')
+def _create_child_page_item(block: dict, page_id: str) -> IntegrationItem:
+    """IntegrationItem for a child_page/child_database block that search did not return"""
+    item_type = 'page' if block['type'] == 'child_page' else 'database'
+    return IntegrationItem(
+        id=block['id'],
+        type=item_type,
+        name=f"{item_type} {block[block['type']].get('title', '')}",
+        creation_time=_parse_notion_time(block.get('created_time')),
+        last_modified_time=_parse_notion_time(block.get('last_edited_time')),
+        parent_id=page_id,
+    )
+
+async def expand_children(access_token, items: dict) -> dict:
+    """Walks the block tree of every page concurrently, adding child pages search missed.
+
+    Returns the block -> owning page map used to re-parent items nested inside blocks.
+    """
+    semaphore = asyncio.Semaphore(BLOCKS_FETCH_CONCURRENCY)
+    block_owners = {}
+    expanded = set()
+    pending = [item.id for item in items.values() if item.type == 'page']
+    while pending:
+        expanded.update(pending)
+        child_pages_per_page = await asyncio.gather(
+            *(fetch_child_pages(access_token, page_id, semaphore, block_owners) for page_id in pending)
+        )
+        next_pending = []
+        for page_id, child_pages in zip(pending, child_pages_per_page):
+            for block in child_pages:
+                if block['id'] not in items:
+                    items[block['id']] = _create_child_page_item(block, page_id)
+                if block['type'] == 'child_page' and block['id'] not in expanded:
+                    next_pending.append(block['id'])
+        pending = next_pending
+    return block_owners
+
+def build_hierarchy(list_of_integration_item_metadata, block_owners=None):
+    """Fills parent_id, parent_path_or_name, children and directory across the loaded items"""
+    block_owners = block_owners or {}
+    items = {item.id: item for item in list_of_integration_item_metadata}
+    for item in list_of_integration_item_metadata:
+        # Pages nested in layout blocks point at the block; use the page that owns it
+        if item.parent_id not in items and item.parent_id in block_owners:
+            item.parent_id = block_owners[item.parent_id]
+
+    for item in list_of_integration_item_metadata:
+        parent = items.get(item.parent_id)
+        if parent is not None:
+            if parent.children is None:
+                parent.children = []
+            parent.children.append(item.id)
+            item.parent_path_or_name = parent.name
+
+    for item in list_of_integration_item_metadata:
+        item.directory = bool(item.children) or item.type == 'database'
+    return list_of_integration_item_metadata
+
+async def get_items_notion(credentials, since=None, expand=True) -> list[IntegrationItem]:
+    """Aggregates all metadata relevant for a notion integration.
+
+    Full loads also walk each page's blocks to pick up child pages and fill in the hierarchy;
+    delta loads (`since`) return only the changed items, flat.
+    """
+    list_of_integration_item_metadata = []
+    async for items in iter_items_notion(credentials, since=since):
+        list_of_integration_item_metadata.extend(items)
+    if since is not None:
+        return list_of_integration_item_metadata
+
+    block_owners = {}
+    if expand:
+        items = {item.id: item for item in list_of_integration_item_metadata}
+        block_owners = await expand_children(json.loads(credentials).get('access_token'), items)
+        list_of_integration_item_metadata = list(items.values())
+    return build_hierarchy(list_of_integration_item_metadata, block_owners)
+
+async def iter_full_items_notion(credentials):
+    """Like get_items_notion, but yields an empty list per search page as progress while it runs.
+
+    The items themselves come in one final list, since their hierarchy needs every page.
+    """
+    items = {}
+    async for page in iter_items_notion(credentials):
+        items.update((item.id, item) for item in page)
+        yield []
+    block_owners = await expand_children(json.loads(credentials).get('access_token'), items)
+    yield build_hierarchy(list(items.values()), block_owners)
+
+async def get_delta_items_notion(credentials, user_id, org_id) -> list[IntegrationItem]:
+    """Returns the pages and databases edited since the last delta load."""
+    watermark = await get_watermark('notion', user_id, org_id)
+    since = _parse_notion_time(watermark.get('since')) if watermark else None
+
+    list_of_integration_item_metadata = await get_items_notion(credentials, since=since)
+    for item in list_of_integration_item_metadata:
+        item.delta = item.delta or 'upsert'
 
-        print(list_of_integration_item_metadata)
-    return
+    await save_watermark('notion', user_id, org_id, {
+        'since': latest_modified_time(
+            (item.last_modified_time for item in list_of_integration_item_metadata),
+            default=watermark.get('since') if watermark else None,
+        ),
+    })
+    return list_of_integration_item_metadata
@@ -0,0 +1,80 @@
+import importlib
+from dataclasses import dataclass, field
+
+from fastapi import HTTPException
+
+
+@dataclass
+class Provider:
+    """An integration, wired up by naming convention in its `integrations.<name>` module.
+
+    The module must define authorize_<name>, oauth2callback_<name>, get_<name>_credentials,
+    get_items_<name>, get_delta_items_<name> and iter_items_<name>, plus subscribe_webhooks_<name>,
+    receive_webhook_<name> and apply_webhook_events_<name> when it takes webhooks. It is only
+    imported the first time one of them is used, so its client libraries stay off the startup path.
+    """
+    name: str
+    # 'form' posts credentials and load options as form fields; 'json' posts the credentials
+    # as a JSON body and takes load options from the query string
+    credentials_format: str = 'form'
+    # Query options forwarded to the loaders (and part of the cache key), with their defaults
+    load_options: dict = field(default_factory=dict)
+    # Loader for background jobs, when a full load needs more than iter_items_<name> yields
+    job_loader: str = None
+    # Whether the provider pushes changes to webhook routes (see webhooks.py)
+    webhooks: bool = False
+
+    @property
+    def module(self):
+        return importlib.import_module(f'integrations.{self.name}')
+
+    def function(self, template):
+        return getattr(self.module, template.format(name=self.name))
+
+    async def authorize(self, user_id, org_id):
+        return await self.function('authorize_{name}')(user_id, org_id)
+
+    async def oauth2callback(self, request):
+        return await self.function('oauth2callback_{name}')(request)
+
+    async def get_credentials(self, user_id, org_id):
+        return await self.function('get_{name}_credentials')(user_id, org_id)
+
+    async def get_items(self, credentials, **options):
+        return await self.function('get_items_{name}')(credentials, **options)
+
+    async def get_delta_items(self, credentials, user_id, org_id):
+        return await self.function('get_delta_items_{name}')(credentials, user_id, org_id)
+
+    def iter_items(self, credentials, **options):
+        return self.function('iter_items_{name}')(credentials, **options)
+
+    def iter_job_items(self, credentials, **options):
+        return self.function(self.job_loader or 'iter_items_{name}')(credentials, **options)
+
+    async def subscribe_webhooks(self, user_id, org_id):
+        return await self.function('subscribe_webhooks_{name}')(user_id, org_id)
+
+    async def receive_webhook(self, request):
+        return await self.function('receive_webhook_{name}')(request)
+
+    async def apply_webhook_events(self, events):
+        return await self.function('apply_webhook_events_{name}')(events)
+
+
+PROVIDERS = {
+    provider.name: provider
+    for provider in (
+        Provider('airtable', load_options={'properties': None}, webhooks=True),
+        # Notion's hierarchy is only known once every page has been walked
+        Provider('notion', job_loader='iter_full_items_notion'),
+        Provider('hubspot', credentials_format='json', load_options={'mode': 'list', 'properties': None}, webhooks=True),
+    )
+}
+
+
+def get_provider(name):
+    provider = PROVIDERS.get(name)
+    if provider is None:
+        raise HTTPException(status_code=404, detail=f'Unknown integration: {name}')
+    return provider
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+
+import orjson
+
+from integrations.integration_item import IntegrationItem, encode_items
+from integrations.item_tree import materialize_tree
+from redis_client import (
+    add_key_value_redis,
+    add_key_value_if_absent_redis,
+    get_value_redis,
+    delete_key_redis,
+    delete_keys_matching_redis,
+    get_keys_matching_redis,
+    register_script_redis,
+)
+
+logger = logging.getLogger(__name__)
+
+# Loads younger than the TTL are served as-is; older ones up to TTL + stale TTL are served
+# immediately while a background refresh replaces them
+ITEM_CACHE_TTL = int(os.environ.get('ITEM_CACHE_TTL', 300))
+ITEM_CACHE_STALE_TTL = int(os.environ.get('ITEM_CACHE_STALE_TTL', 3600))
+# How long one worker may hold the load lock before others stop waiting on it
+ITEM_CACHE_LOCK_TIMEOUT = int(os.environ.get('ITEM_CACHE_LOCK_TIMEOUT', 120))
+ITEM_CACHE_POLL_INTERVAL = 0.5
+
+# Loads in flight in this process, so identical concurrent requests share one upstream fetch
+_inflight = {}
+# Strong references to background refreshes so they aren't garbage collected mid-run
+_refreshes = set()
+
+# Entries are stored as b'<stored_at>\n<encoded JSON>' so hits are returned without re-encoding
+
+# Swap in a patched entry only if no new load has replaced it meanwhile; age and expiry are kept
+_REPLACE_ENTRY_SCRIPT = """
+if redis.call('GETRANGE', KEYS[1], 0, string.len(ARGV[1]) - 1) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'KEEPTTL')
+return 1
+"""
+_replace_entry = None
+
+
+def account_key(credentials):
+    """Stable, non-reversible identity for the account behind a set of credentials."""
+    if isinstance(credentials, str):
+        try:
+            credentials = json.loads(credentials)
+        except json.JSONDecodeError:
+            pass
+    if isinstance(credentials, dict) and credentials.get('access_token'):
+        identity = credentials['access_token']
+    else:
+        identity = json.dumps(credentials, sort_keys=True, default=str)
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def _cache_key(provider, account, params):
+    params_hash = hashlib.sha256(json.dumps(params or {}, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return f'item_cache:{provider}:{account}:{params_hash}'
+
+
+def _parse_entry(entry):
+    stored_at, _, payload = entry.partition(b'\n')
+    return time.time() - float(stored_at), payload
+
+
+async def _store(key, payload):
+    entry = f'{time.time():.3f}\n'.encode('utf-8') + payload
+    await add_key_value_redis(key, entry, expire=ITEM_CACHE_TTL + ITEM_CACHE_STALE_TTL)
+
+
+async def _load_and_store(key, loader, should_cache):
+    """Run the loader once across workers: the Redis lock holder loads, others wait for its result."""
+    lock_key = f'{key}:lock'
+    locked = await add_key_value_if_absent_redis(lock_key, 1, ITEM_CACHE_LOCK_TIMEOUT)
+    if not locked:
+        deadline = time.monotonic() + ITEM_CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(ITEM_CACHE_POLL_INTERVAL)
+            entry = await get_value_redis(key)
+            if entry:
+                age, payload = _parse_entry(entry)
+                if age < ITEM_CACHE_TTL:
+                    return payload
+            if not await get_value_redis(lock_key):
+                break
+    try:
+        result = await loader()
+        payload = encode_items(result)
+        if should_cache is None or should_cache(result):
+            await _store(key, payload)
+        return payload
+    finally:
+        if locked:
+            await delete_key_redis(lock_key)
+
+
+def _refresh_done(task):
+    _refreshes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Background cache refresh failed: %s', task.exception())
+
+
+def _single_flight(key, loader, should_cache):
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_load_and_store(key, loader, should_cache))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return task
+
+
+async def cached_load(provider, credentials, loader, params=None, refresh=False, should_cache=None):
+    """Serve a loader's result, encoded as JSON bytes, from the Redis item cache.
+
+    `loader` is a zero-argument coroutine function producing the items; `params` are the
+    request parameters that change its output. `should_cache` can veto storing a result
+    (e.g. error payloads). `refresh` skips the cache and replaces the entry.
+    """
+    key = _cache_key(provider, account_key(credentials), params)
+
+    if not refresh:
+        entry = await get_value_redis(key)
+        if entry:
+            age, payload = _parse_entry(entry)
+            if age >= ITEM_CACHE_TTL and key not in _inflight:
+                refresh_task = _single_flight(key, loader, should_cache)
+                _refreshes.add(refresh_task)
+                refresh_task.add_done_callback(_refresh_done)
+            return payload
+
+    return await asyncio.shield(_single_flight(key, loader, should_cache))
+
+
+async def invalidate_cache(provider, credentials):
+    """Drop every cached load for the account behind these credentials."""
+    await delete_keys_matching_redis(f'item_cache:{provider}:{account_key(credentials)}:*')
+
+
+def _patch_payload(payload, upserts, deleted):
+    """Encoded load with `upserts` merged in and the (type, id) pairs in `deleted` removed.
+
+    None when the load can't be patched: loads projecting properties, which the pushed items don't carry.
+    """
+    result = orjson.loads(payload)
+    loaded = result.get('items', []) if isinstance(result, dict) else result
+    if any(item.get('properties') is not None for item in loaded):
+        return None
+    items = {(item.get('type'), item.get('id')): IntegrationItem(**item) for item in loaded}
+    for key in deleted:
+        items.pop(key, None)
+    for item in upserts:
+        items[(item.type, item.id)] = item
+    patched = list(items.values())
+    # Children lists and paths may have changed with the patch
+    materialize_tree(patched)
+    if isinstance(result, dict):
+        result['items'] = patched
+        if 'count' in result:
+            result['count'] = len(patched)
+        return encode_items(result)
+    return encode_items(patched)
+
+
+async def patch_cache(provider, credentials, upserts, deleted):
+    """Apply changed items and deletions to every cached load of an account in place.
+
+    `upserts` are IntegrationItems, `deleted` (type, id) pairs. Patched entries keep their
+    age, so pushed changes keep reads as cache hits without resetting the refresh schedule.
+    Loads with a property projection are dropped instead and reload on their next read.
+    """
+    global _replace_entry
+    if _replace_entry is None:
+        _replace_entry = register_script_redis(_REPLACE_ENTRY_SCRIPT)
+    for key in await get_keys_matching_redis(f'item_cache:{provider}:{account_key(credentials)}:*'):
+        if key.endswith(b':lock'):
+            continue
+        entry = await get_value_redis(key)
+        if not entry:
+            continue
+        stored_at, _, payload = entry.partition(b'\n')
+        patched = await asyncio.to_thread(_patch_payload, payload, upserts, deleted)
+        if patched is None:
+            await delete_key_redis(key)
+        else:
+            await _replace_entry(keys=[key], args=[stored_at + b'\n', stored_at + b'\n' + patched])
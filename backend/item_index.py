@@ -0,0 +1,447 @@
+"""Searchable local index of loaded IntegrationItems, per (org, user, provider).
+
+Items are kept in SQLite with an FTS5 table over their names, so they can be found and
+filtered without reloading from the provider. An item is identified by its type and id, since
+some providers (HubSpot) only number records uniquely within a type. Loads feed it in the background: a full load
+replaces the account's items, a delta load applies its upserts and tombstones. After every
+write the account's hierarchy is re-materialized (ItemTree), so subtrees can be listed one
+level at a time.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+import orjson
+from fastapi import HTTPException
+
+from integrations.item_tree import ItemTree
+
+logger = logging.getLogger(__name__)
+
+ITEM_INDEX_PATH = os.environ.get('ITEM_INDEX_PATH', 'item_index.sqlite3')
+# Longest SQLite waits on another writer before giving up
+ITEM_INDEX_BUSY_TIMEOUT = float(os.environ.get('ITEM_INDEX_BUSY_TIMEOUT', 10))
+ITEM_INDEX_MAX_PAGE_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    org_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    id TEXT NOT NULL,
+    type TEXT NOT NULL DEFAULT '',
+    parent_id TEXT,
+    name TEXT COLLATE NOCASE,
+    modified_at REAL,
+    generation INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    -- Materialized hierarchy: the resolved parent (NULL for roots), depth, path and sizes
+    tree_parent_type TEXT,
+    tree_parent_id TEXT,
+    depth INTEGER,
+    path TEXT,
+    child_count INTEGER,
+    subtree_size INTEGER,
+    PRIMARY KEY (org_id, user_id, provider, type, id)
+);
+CREATE INDEX IF NOT EXISTS items_by_modified ON items (org_id, user_id, provider, modified_at);
+CREATE INDEX IF NOT EXISTS items_by_type ON items (org_id, user_id, provider, type, modified_at);
+CREATE INDEX IF NOT EXISTS items_by_parent ON items (org_id, user_id, provider, parent_id);
+CREATE INDEX IF NOT EXISTS items_by_name ON items (org_id, user_id, provider, name);
+CREATE INDEX IF NOT EXISTS items_by_tree_parent ON items (org_id, user_id, provider, tree_parent_id, tree_parent_type, name);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(name, content='items', content_rowid='rowid', prefix='2 3');
+CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts (rowid, name) VALUES (new.rowid, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+    INSERT INTO items_fts (rowid, name) VALUES (new.rowid, new.name);
+END;
+
+-- Digest of the last full load indexed per account, so re-served cache hits are skipped
+CREATE TABLE IF NOT EXISTS index_state (
+    org_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (org_id, user_id, provider)
+);
+"""
+
+_UPSERT = """
+INSERT INTO items (org_id, user_id, provider, id, type, parent_id, name, modified_at, generation, data)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (org_id, user_id, provider, type, id) DO UPDATE SET
+    parent_id = excluded.parent_id, name = excluded.name,
+    modified_at = excluded.modified_at, generation = excluded.generation, data = excluded.data
+"""
+
+# Fields only a full load can fill in, kept when a delta load or webhook updates an item
+_HIERARCHY_FIELDS = ('directory', 'children', 'parent_id', 'parent_path_or_name')
+# Ids per IN (...) lookup, well under SQLite's bound-parameter limit
+_LOOKUP_BATCH = 500
+
+# One connection per worker thread; SQLite connections can't be shared across threads
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+# Strong references to background indexing so it isn't garbage collected mid-run
+_pending = set()
+
+
+def _connection():
+    global _schema_ready
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(ITEM_INDEX_PATH, timeout=ITEM_INDEX_BUSY_TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with _schema_lock:
+            if not _schema_ready:
+                _migrate(connection)
+                connection.executescript(_SCHEMA)
+                _schema_ready = True
+        _local.connection = connection
+    return connection
+
+
+def _migrate(connection):
+    """Drop an index keyed on id alone; the next load of each account rebuilds it from scratch."""
+    key = {row[1] for row in connection.execute('PRAGMA table_info(items)') if row[5]}
+    if not key or 'type' in key:
+        return
+    logger.warning('Rebuilding the item index, which predates keying items by type')
+    connection.executescript(
+        'DROP TABLE IF EXISTS items_fts; DROP TABLE IF EXISTS items; DROP TABLE IF EXISTS index_state;'
+    )
+
+
+def _materialize_tree(connection, scope):
+    """Recompute the account's hierarchy columns, writing only the rows that changed.
+
+    Tree nodes are (type, id) pairs. A parent_id names no type, so it resolves to another item
+    with that id, preferring one of the child's own type when ids repeat across types.
+    """
+    rows = connection.execute(
+        'SELECT type, id, parent_id, name, tree_parent_type, tree_parent_id, depth, path, child_count, subtree_size '
+        'FROM items WHERE org_id = ? AND user_id = ? AND provider = ? ORDER BY type',
+        scope,
+    ).fetchall()
+    by_id = {}
+    for item_type, item_id, *_ in rows:
+        by_id.setdefault(item_id, {})[item_type] = (item_type, item_id)
+
+    def parent_key(item_type, item_id, parent_id):
+        candidates = dict(by_id.get(parent_id, {}))
+        if parent_id == item_id:
+            candidates.pop(item_type, None)
+        if not candidates:
+            return parent_id
+        return candidates.get(item_type) or next(iter(candidates.values()))
+
+    tree = ItemTree(
+        ((item_type, item_id), parent_key(item_type, item_id, parent_id), name or item_id)
+        for item_type, item_id, parent_id, name, *_ in rows
+    )
+    updates = []
+    for item_type, item_id, _, _, *current in rows:
+        key = (item_type, item_id)
+        parent_type, parent_id = tree.parents[key] or (None, None)
+        materialized = (
+            parent_type, parent_id, tree.depths[key], tree.paths[key], len(tree.children[key]), tree.sizes[key],
+        )
+        if tuple(current) != materialized:
+            updates.append((*materialized, *scope, item_type, item_id))
+    connection.executemany(
+        'UPDATE items SET tree_parent_type = ?, tree_parent_id = ?, depth = ?, path = ?, child_count = ?, subtree_size = ? '
+        'WHERE org_id = ? AND user_id = ? AND provider = ? AND type = ? AND id = ?',
+        updates,
+    )
+
+
+def _timestamp(value):
+    """Epoch seconds for an ISO datetime string, so ranges compare across UTC offsets."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _loaded_items(payload):
+    """(items, complete) from an encoded loader result; None for error payloads.
+
+    `complete` is False for HubSpot loads that were cut short, whose missing items may still exist.
+    """
+    result = orjson.loads(payload)
+    if isinstance(result, dict):
+        if 'error' in result:
+            return None
+        complete = not result.get('truncated') and not result.get('failed_object_types')
+        return result.get('items', []), complete
+    return result, True
+
+
+def _keep_hierarchy(connection, scope, items):
+    """Give partially loaded items the hierarchy fields stored for them by the last full load.
+
+    Delta loads and webhooks convert records on their own, so they don't know an item's children
+    or whether it is a folder, and their parent_id is the provider's raw one.
+    """
+    stored = {}
+    for start in range(0, len(items), _LOOKUP_BATCH):
+        batch = items[start:start + _LOOKUP_BATCH]
+        rows = connection.execute(
+            f'SELECT type, id, data FROM items WHERE org_id = ? AND user_id = ? AND provider = ? '
+            f'AND id IN ({", ".join("?" * len(batch))})',
+            (*scope, *(item['id'] for item in batch)),
+        )
+        stored.update(((item_type, item_id), data) for item_type, item_id, data in rows)
+    for item in items:
+        data = stored.get((item.get('type') or '', item['id']))
+        if data is not None:
+            previous = orjson.loads(data)
+            for field in _HIERARCHY_FIELDS:
+                item[field] = previous.get(field)
+
+
+def _index(provider, user_id, org_id, payload, replace):
+    loaded = _loaded_items(payload)
+    if loaded is None:
+        return
+    items, complete = loaded
+    replace = replace and complete
+    scope = (org_id, user_id, provider)
+    digest = hashlib.blake2b(payload, digest_size=16).digest()
+    connection = _connection()
+
+    if replace:
+        state = connection.execute(
+            'SELECT digest FROM index_state WHERE org_id = ? AND user_id = ? AND provider = ?', scope
+        ).fetchone()
+        if state and state[0] == digest:
+            return
+
+    generation = time.time_ns()
+    upserts = []
+    deleted = []
+    for item in items:
+        if not item.get('id'):
+            continue
+        if item.get('delta') == 'deleted':
+            deleted.append((*scope, item.get('type') or '', item['id']))
+            continue
+        # The index holds current items, not the load's change markers
+        item['delta'] = None
+        upserts.append(item)
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if not replace:
+            _keep_hierarchy(connection, scope, upserts)
+        connection.executemany(_UPSERT, [
+            (
+                *scope, item['id'], item.get('type') or '', item.get('parent_id'), item.get('name'),
+                _timestamp(item.get('last_modified_time')), generation, orjson.dumps(item),
+            )
+            for item in upserts
+        ])
+        connection.executemany(
+            'DELETE FROM items WHERE org_id = ? AND user_id = ? AND provider = ? AND type = ? AND id = ?', deleted
+        )
+        if replace:
+            connection.execute(
+                'DELETE FROM items WHERE org_id = ? AND user_id = ? AND provider = ? AND generation != ?',
+                (*scope, generation),
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO index_state (org_id, user_id, provider, digest, indexed_at) VALUES (?, ?, ?, ?, ?)',
+                (*scope, digest, time.time()),
+            )
+        _materialize_tree(connection, scope)
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    logger.info('Indexed %d %s items', len(upserts), provider, extra={'deleted': len(deleted), 'replace': replace})
+
+
+async def index_items(provider, user_id, org_id, payload, replace=True):
+    """Index an encoded loader result for an account.
+
+    With `replace`, items missing from the payload are dropped (a full load); otherwise only
+    its upserts and `delta == 'deleted'` tombstones are applied (a delta load).
+    """
+    await asyncio.to_thread(_index, provider, user_id, org_id, payload, replace)
+
+
+def _index_done(task):
+    _pending.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Indexing loaded items failed: %s', task.exception())
+
+
+def index_in_background(provider, user_id, org_id, payload, replace=True):
+    """index_items without holding up the response; a no-op unless the load names its account."""
+    if not user_id or not org_id:
+        return
+    task = asyncio.ensure_future(index_items(provider, user_id, org_id, payload, replace))
+    _pending.add(task)
+    task.add_done_callback(_index_done)
+
+
+def _match_expression(text):
+    """FTS5 query matching every word of `text`, the last one as a prefix."""
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def _query(provider, user_id, org_id, q, prefix, item_type, parent_id, modified_after, modified_before, limit, offset):
+    conditions = ['items.org_id = ?', 'items.user_id = ?', 'items.provider = ?']
+    args = [org_id, user_id, provider]
+    source = 'items'
+    order = 'items.modified_at IS NULL, items.modified_at DESC, items.id'
+
+    match = _match_expression(q) if q else None
+    if match:
+        source = 'items_fts JOIN items ON items.rowid = items_fts.rowid'
+        conditions.append('items_fts MATCH ?')
+        args.append(match)
+        order = 'items_fts.rank, items.id'
+    if prefix:
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("items.name LIKE ? ESCAPE '\\'")
+        args.append(escaped + '%')
+    if item_type:
+        conditions.append('items.type = ?')
+        args.append(item_type)
+    if parent_id:
+        conditions.append('items.parent_id = ?')
+        args.append(parent_id)
+    if modified_after is not None:
+        conditions.append('items.modified_at >= ?')
+        args.append(modified_after)
+    if modified_before is not None:
+        conditions.append('items.modified_at < ?')
+        args.append(modified_before)
+
+    # One extra row tells whether there is a next page without counting every match
+    rows = _connection().execute(
+        f'SELECT items.data FROM {source} WHERE {" AND ".join(conditions)} ORDER BY {order} LIMIT ? OFFSET ?',
+        (*args, limit + 1, offset),
+    ).fetchall()
+    next_offset = offset + limit if len(rows) > limit else None
+    return b'{"items":[' + b','.join(row[0] for row in rows[:limit]) + b'],"next_offset":' + orjson.dumps(next_offset) + b'}'
+
+
+def _epoch(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+async def query_items(provider, user_id, org_id, q=None, prefix=None, item_type=None, parent_id=None,
+                      modified_after=None, modified_before=None, limit=100, offset=0):
+    """One page of an account's indexed items as JSON bytes: {"items": [...], "next_offset": int | null}.
+
+    `q` is full-text search over names (the last word matched as a prefix), `prefix` a
+    case-insensitive name prefix; the modification range is [modified_after, modified_before).
+    Results are ordered by relevance for `q`, otherwise most recently modified first.
+    """
+    limit = max(1, min(limit, ITEM_INDEX_MAX_PAGE_SIZE))
+    return await asyncio.to_thread(
+        _query, provider, user_id, org_id, q, prefix, item_type, parent_id,
+        _epoch(modified_after), _epoch(modified_before), limit, max(offset, 0),
+    )
+
+
+_TREE_COLUMNS = 'data, tree_parent_type, tree_parent_id, depth, path, child_count, subtree_size, type'
+
+
+def _tree_node(row):
+    """An item's stored JSON with its materialized hierarchy added under "tree"."""
+    data, parent_type, parent_id, depth, path, child_count, subtree_size, _ = row
+    tree = {
+        'parent_id': parent_id, 'parent_type': parent_type, 'depth': depth, 'path': path,
+        'child_count': child_count, 'subtree_size': subtree_size,
+    }
+    return data[:-1] + b',"tree":' + orjson.dumps(tree) + b'}'
+
+
+def _tree_level(provider, user_id, org_id, node_id, node_type, limit, offset):
+    connection = _connection()
+    scope = (org_id, user_id, provider)
+    node = b'null'
+    if node_id is not None:
+        conditions = 'org_id = ? AND user_id = ? AND provider = ? AND id = ?'
+        args = (*scope, node_id)
+        if node_type is not None:
+            conditions += ' AND type = ?'
+            args += (node_type,)
+        matches = connection.execute(f'SELECT {_TREE_COLUMNS} FROM items WHERE {conditions} LIMIT 2', args).fetchall()
+        if not matches:
+            return None
+        if len(matches) > 1:
+            raise HTTPException(status_code=400, detail=f'Several indexed items have id {node_id}; pass node_type.')
+        node = _tree_node(matches[0])
+        node_type = matches[0][-1]
+    rows = connection.execute(
+        f'SELECT {_TREE_COLUMNS} FROM items WHERE org_id = ? AND user_id = ? AND provider = ? '
+        'AND tree_parent_id IS ? AND tree_parent_type IS ? ORDER BY child_count = 0, name, type, id LIMIT ? OFFSET ?',
+        (*scope, node_id, node_type, limit + 1, offset),
+    ).fetchall()
+    next_offset = offset + limit if len(rows) > limit else None
+    return (
+        b'{"node":' + node + b',"children":[' + b','.join(_tree_node(row) for row in rows[:limit])
+        + b'],"next_offset":' + orjson.dumps(next_offset) + b'}'
+    )
+
+
+async def get_tree_level(provider, user_id, org_id, node_id=None, node_type=None, limit=100, offset=0):
+    """One level of an account's item tree as JSON bytes: {"node", "children": [...], "next_offset"}.
+
+    Without `node_id` the children are the roots. `node_type` picks the node when its id is
+    shared by items of several types. Nodes carry their parent, depth, path,
+    child_count and subtree_size under "tree"; folders come first, then by name.
+    """
+    limit = max(1, min(limit, ITEM_INDEX_MAX_PAGE_SIZE))
+    level = await asyncio.to_thread(_tree_level, provider, user_id, org_id, node_id, node_type, limit, max(offset, 0))
+    if level is None:
+        raise HTTPException(status_code=404, detail=f'Item not indexed: {node_id}')
+    return level
+
+
+def _clear(provider, user_id, org_id):
+    connection = _connection()
+    scope = (org_id, user_id, provider)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM items WHERE org_id = ? AND user_id = ? AND provider = ?', scope)
+        connection.execute('DELETE FROM index_state WHERE org_id = ? AND user_id = ? AND provider = ?', scope)
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+
+async def clear_index(provider, user_id, org_id):
+    """Forget every indexed item of an account."""
+    await asyncio.to_thread(_clear, provider, user_id, org_id)
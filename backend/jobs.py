@@ -0,0 +1,190 @@
+"""Background load jobs for accounts too large to load within one HTTP request.
+
+The API enqueues a job and returns its id straight away; Celery workers (started with
+`celery -A jobs worker` from this directory) run the provider loaders and write progress
+and results to Redis, where the job endpoints read them.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+# Settings are read from the environment as modules are imported, so .env goes first
+load_dotenv()
+
+from logging_config import configure_logging
+
+configure_logging()
+
+from celery import Celery
+from celery.signals import worker_process_shutdown
+from fastapi import HTTPException
+
+from http_client import close_http_clients
+from integrations.integration_item import encode_items
+from integrations.registry import get_provider
+from redis_client import (
+    close_redis,
+    redis_host,
+    redis_port,
+    redis_db,
+    add_key_value_redis,
+    get_and_delete_value_redis,
+    get_hash_redis,
+    get_list_item_redis,
+    pipeline_redis,
+)
+
+logger = logging.getLogger(__name__)
+
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', f'redis://{redis_host}:{redis_port}/{redis_db}')
+# Items per stored result chunk, which is also the page size of GET /jobs/{job_id}/results
+JOB_RESULT_CHUNK_SIZE = int(os.environ.get('JOB_RESULT_CHUNK_SIZE', 1000))
+# How long job state and results are kept after the last update
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))
+
+celery_app = Celery('jobs', broker=CELERY_BROKER_URL)
+celery_app.conf.update(
+    task_serializer='json',
+    accept_content=['json'],
+    # Loads run for minutes; hand a worker one at a time and only ack once it finishes
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+)
+
+
+def _job_key(job_id):
+    return f'job:{job_id}'
+
+
+def _results_key(job_id):
+    return f'job:{job_id}:results'
+
+
+def _credentials_key(job_id):
+    return f'job:{job_id}:credentials'
+
+
+async def enqueue_load_job(provider, credentials, params=None):
+    """Queue a full load and return its id; credentials are kept in Redis, not in the task message."""
+    get_provider(provider)
+    if not isinstance(credentials, str):
+        credentials = json.dumps(credentials)
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    async with pipeline_redis() as pipe:
+        pipe.hset(_job_key(job_id), mapping={
+            'provider': provider,
+            'status': 'queued',
+            'pages': 0,
+            'items': 0,
+            'chunks': 0,
+            'created_at': now,
+            'updated_at': now,
+        })
+        pipe.expire(_job_key(job_id), JOB_RESULT_TTL)
+        await pipe.execute()
+    await add_key_value_redis(_credentials_key(job_id), credentials, expire=JOB_RESULT_TTL)
+
+    # Publishing to the broker is blocking I/O
+    await asyncio.to_thread(run_load_job.apply_async, args=(job_id, provider, params or {}), task_id=job_id)
+    return job_id
+
+
+async def get_job(job_id):
+    """Status and progress counters of a job."""
+    job = await get_hash_redis(_job_key(job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail='Job not found.')
+    job = {key.decode('utf-8'): value.decode('utf-8') for key, value in job.items()}
+    for counter in ('pages', 'items', 'chunks'):
+        job[counter] = int(job[counter])
+    for timestamp in ('created_at', 'updated_at', 'finished_at'):
+        if timestamp in job:
+            job[timestamp] = float(job[timestamp])
+    job['job_id'] = job_id
+    return job
+
+
+async def get_job_results(job_id, chunk):
+    """One stored chunk of a job's items as encoded JSON, plus the job state.
+
+    Chunks are readable while the job is still running; `chunks` in the state says how many exist so far.
+    """
+    job = await get_job(job_id)
+    if chunk < 0 or chunk >= job['chunks']:
+        raise HTTPException(status_code=404, detail=f'Chunk {chunk} not available; job has {job["chunks"]} chunks.')
+    return await get_list_item_redis(_results_key(job_id), chunk), job
+
+
+async def _record_progress(job_id, pages=0, items=None, status=None, error=None):
+    job_key = _job_key(job_id)
+    async with pipeline_redis() as pipe:
+        if pages:
+            pipe.hincrby(job_key, 'pages', pages)
+        if items:
+            pipe.rpush(_results_key(job_id), encode_items(items))
+            pipe.hincrby(job_key, 'items', len(items))
+            pipe.hincrby(job_key, 'chunks', 1)
+            pipe.expire(_results_key(job_id), JOB_RESULT_TTL)
+        fields = {'updated_at': time.time()}
+        if status:
+            fields['status'] = status
+            if status in ('done', 'failed'):
+                fields['finished_at'] = fields['updated_at']
+        if error:
+            fields['error'] = error
+        pipe.hset(job_key, mapping=fields)
+        pipe.expire(job_key, JOB_RESULT_TTL)
+        await pipe.execute()
+
+
+async def run_job(job_id, provider, params):
+    """Run a provider loader, storing its items in chunks as pages arrive."""
+    credentials = await get_and_delete_value_redis(_credentials_key(job_id))
+    if credentials is None:
+        await _record_progress(job_id, status='failed', error='Job credentials expired before it started.')
+        return
+
+    await _record_progress(job_id, status='running')
+    buffer = []
+    try:
+        async for page in get_provider(provider).iter_job_items(credentials.decode('utf-8'), **params):
+            buffer.extend(page)
+            while len(buffer) >= JOB_RESULT_CHUNK_SIZE:
+                await _record_progress(job_id, items=buffer[:JOB_RESULT_CHUNK_SIZE])
+                buffer = buffer[JOB_RESULT_CHUNK_SIZE:]
+            await _record_progress(job_id, pages=1)
+        await _record_progress(job_id, items=buffer, status='done')
+    except Exception as e:
+        logger.exception('Load job %s failed', job_id, extra={'job_id': job_id, 'provider': provider})
+        await _record_progress(job_id, items=buffer, status='failed', error=getattr(e, 'detail', None) or str(e))
+
+
+# Each worker process runs every job on one long-lived loop, so pooled HTTP and Redis
+# connections (and rate limit locks) stay bound to the loop that created them
+_loop = None
+
+
+def _run(coroutine):
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coroutine)
+
+
+@celery_app.task(name='jobs.run_load_job')
+def run_load_job(job_id, provider, params):
+    _run(run_job(job_id, provider, params))
+
+
+@worker_process_shutdown.connect
+def close_worker_clients(**kwargs):
+    if _loop is not None:
+        _run(close_http_clients())
+        _run(close_redis())
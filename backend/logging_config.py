@@ -0,0 +1,113 @@
+"""Leveled, structured logging that never blocks the event loop on output.
+
+Records are redacted and queued in the calling thread; a QueueListener thread formats
+and writes them. Per-item DEBUG lines logged with `extra={'sample': True}` are kept at
+LOG_SAMPLE_RATE so debug logging stays affordable on large loads.
+"""
+import os
+import re
+import sys
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+import orjson
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 'json' for log shippers, 'text' for reading locally
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+# Records dropped rather than waited for once this many are pending
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+REDACTED = '[REDACTED]'
+_SECRET_PATTERNS = (
+    re.compile(r'((?:Bearer|Basic)\s+)[A-Za-z0-9\-._~+/]+=*'),
+    re.compile(r'''(["']?\b(?:access_token|refresh_token|client_secret|code_verifier|id_token|code)["']?\s*[:=]\s*["']?)[^"'&,\s}]+'''),
+)
+# LogRecord attributes that aren't user-supplied `extra` fields
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'sample'}
+
+_listener = None
+
+
+def redact(text):
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(lambda match: match.group(1) + REDACTED, text)
+    return text
+
+
+class RedactingFilter(logging.Filter):
+    """Renders the message and strips tokens from it before it leaves the calling thread."""
+
+    def filter(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = redact(logging.Formatter().formatException(record.exc_info))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only LOG_SAMPLE_RATE of the DEBUG records marked `sample`."""
+
+    def filter(self, record):
+        return not (record.levelno <= logging.DEBUG and getattr(record, 'sample', False)) or random.random() < LOG_SAMPLE_RATE
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return orjson.dumps(entry, default=str).decode('utf-8')
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The filters already rendered the message and exception; keep the record's extra fields
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def configure_logging():
+    """Route the root logger through a queue to stderr; safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(RedactingFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every request at INFO; upstream calls are already counted in metrics
+    for name in ('httpx', 'httpcore'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -1,9 +1,39 @@
-from fastapi import FastAPI, Form, Request
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+
+# Settings are read from the environment as modules are imported, so .env goes first
+load_dotenv()
+
+from logging_config import configure_logging
+
+configure_logging()
+
+from fastapi import FastAPI, Form, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.routing import Match
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import Body
-from integrations.airtable import authorize_airtable, get_items_airtable, oauth2callback_airtable, get_airtable_credentials
-from integrations.notion import authorize_notion, get_items_notion, oauth2callback_notion, get_notion_credentials
-from integrations.hubspot import authorize_hubspot, get_hubspot_credentials, get_items_hubspot, oauth2callback_hubspot
+import orjson
+
+import metrics
+from redis_client import close_redis
+from item_cache import cached_load, invalidate_cache
+from item_index import index_in_background, query_items, get_tree_level, clear_index
+from webhooks import start_webhook_worker, stop_webhook_worker
+from integrations.integration_item import encode_items, arrow_schema, items_to_arrow
+from integrations.item_tree import materialize_tree
+from integrations.registry import PROVIDERS, get_provider
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -19,61 +49,341 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def route_template(scope):
+    """Path template of the route a request matched, so metrics aren't labelled per id."""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+@app.middleware('http')
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Streaming responses are timed to their first byte
+        route = route_template(request.scope)
+        metrics.ROUTE_LATENCY.labels(request.method, route).observe(time.perf_counter() - started)
+        metrics.ROUTE_REQUESTS.labels(request.method, route, str(status)).inc()
+
+@app.on_event('startup')
+async def startup_webhook_worker():
+    start_webhook_worker()
+
+@app.on_event('shutdown')
+async def shutdown_webhook_worker():
+    await stop_webhook_worker()
+
+@app.on_event('shutdown')
+async def shutdown_http_clients():
+    # http_client (and httpx) is only imported once a provider module has been used
+    if 'http_client' in sys.modules:
+        await sys.modules['http_client'].close_http_clients()
+
+@app.on_event('shutdown')
+async def shutdown_redis():
+    await close_redis()
+
 @app.get('/')
 def read_root():
     return {'Ping': 'Pong'}
 
+@app.get('/metrics')
+def get_metrics():
+    body, content_type = metrics.render_metrics()
+    return Response(content=body, media_type=content_type)
+
+def items_response(payload):
+    """JSON response for a loader result, bulk-encoded unless it already arrives as bytes."""
+    if not isinstance(payload, bytes):
+        payload = encode_items(payload)
+    return Response(content=payload, media_type='application/json')
+
+def ndjson_response(pages):
+    """Stream items as NDJSON, one encoded chunk per upstream page, as the loader yields them.
+
+    Headers are already sent by the time a loader fails, so the failure becomes a final error line.
+    """
+    async def lines():
+        try:
+            async for items in pages:
+                if items:
+                    yield b''.join(item.to_json() + b'\n' for item in items)
+        except Exception as e:
+            logger.exception('Streaming load failed')
+            yield encode_items({'error': load_error(e)}) + b'\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+async def job_response(provider, credentials, params=None):
+    """202 with the id of a queued background load, for polling under /jobs."""
+    # Celery is only needed once someone asks for a background load
+    from jobs import enqueue_load_job
+    job_id = await enqueue_load_job(provider, credentials, params)
+    return JSONResponse(status_code=202, content={'job_id': job_id, 'status': 'queued'})
+
+def arrow_response(pages):
+    """Stream items as an Arrow IPC stream, one record batch per upstream page.
+
+    Arrow has no place for an error record, so a loader failing mid-stream aborts the response
+    before the end-of-stream marker, and readers see a truncated stream instead of a short one.
+    """
+    # pyarrow is only needed once someone asks for columnar output
+    import pyarrow.ipc
+
+    async def chunks():
+        sink = io.BytesIO()
+        with pyarrow.ipc.new_stream(sink, arrow_schema()) as writer:
+            async for items in pages:
+                if items:
+                    writer.write_table(items_to_arrow(items))
+                    yield sink.getvalue()
+                    sink.seek(0)
+                    sink.truncate()
+        yield sink.getvalue()
+
+    return StreamingResponse(chunks(), media_type='application/vnd.apache.arrow.stream')
+
+STREAM_RESPONSES = {'ndjson': ndjson_response, 'arrow': arrow_response}
+
+def check_stream_mode(stream, formats=tuple(STREAM_RESPONSES)):
+    if stream is not None and stream not in formats:
+        raise HTTPException(status_code=400, detail=f'Unsupported stream format: {stream}')
+    return stream is not None
+
+def load_error(e):
+    return getattr(e, 'detail', None) or str(e)
+
+async def cached_provider_load(provider, credentials, options, refresh=False):
+    """A provider's full load as JSON bytes, through the item cache, with its hierarchy materialized."""
+    async def load():
+        result = await provider.get_items(credentials, **options)
+        materialize_tree(result.get('items', []) if isinstance(result, dict) else result)
+        return result
+
+    return await cached_load(
+        provider.name,
+        credentials,
+        load,
+        params=options,
+        refresh=refresh,
+        # Loaders that report failures in their payload (HubSpot) shouldn't have them cached
+        should_cache=lambda result: not (isinstance(result, dict) and 'error' in result),
+    )
+
+
+class LoadRequest(NamedTuple):
+    credentials: object
+    refresh: bool
+    delta: bool
+    background: bool
+    user_id: str
+    org_id: str
+    stream: str
+    options: dict
+
+def parse_properties(properties):
+    """Comma-separated property/field names as a sorted list, so equal projections share a cache entry."""
+    names = sorted({name.strip() for name in (properties or '').split(',') if name.strip()})
+    return names or None
+
+def form_load_request(credentials: str = Form(...), refresh: bool = Form(False), delta: bool = Form(False), background: bool = Form(False), user_id: str = Form(None), org_id: str = Form(None), properties: str = Form(None), stream: str = None):
+    return LoadRequest(credentials, refresh, delta, background, user_id, org_id, stream, {'properties': parse_properties(properties)})
+
+def json_load_request(credentials: dict = Body(...), mode: str = 'list', refresh: bool = False, delta: bool = False, background: bool = False, user_id: str = None, org_id: str = None, properties: str = None, stream: str = None):
+    if (background or stream) and not credentials.get("access_token"):
+        raise HTTPException(status_code=400, detail="No access token found in credentials")
+    return LoadRequest(credentials, refresh, delta, background, user_id, org_id, stream, {'mode': mode, 'properties': parse_properties(properties)})
+
+LOAD_REQUEST_PARSERS = {'form': form_load_request, 'json': json_load_request}
+
+def add_provider_routes(provider):
+    """authorize, oauth2callback, credentials and load routes for one registered provider."""
+    @app.post(f'/integrations/{provider.name}/authorize')
+    async def authorize_integration(user_id: str = Form(...), org_id: str = Form(...)):
+        return await provider.authorize(user_id, org_id)
+
+    @app.get(f'/integrations/{provider.name}/oauth2callback')
+    async def oauth2callback_integration(request: Request):
+        return await provider.oauth2callback(request)
+
+    @app.post(f'/integrations/{provider.name}/credentials')
+    async def get_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
+        return await provider.get_credentials(user_id, org_id)
+
+    @app.post(f'/integrations/{provider.name}/load')
+    async def load_items(load: LoadRequest = Depends(LOAD_REQUEST_PARSERS[provider.credentials_format])):
+        options = {name: load.options[name] for name in provider.load_options}
+        if load.background:
+            return await job_response(provider.name, load.credentials, options)
+        if check_stream_mode(load.stream):
+            return STREAM_RESPONSES[load.stream](provider.iter_items(load.credentials, **options))
+        if load.delta:
+            payload = encode_items(await provider.get_delta_items(load.credentials, load.user_id, load.org_id))
+            index_in_background(provider.name, load.user_id, load.org_id, payload, replace=False)
+            return items_response(payload)
+        payload = await cached_provider_load(provider, load.credentials, options, load.refresh)
+        index_in_background(provider.name, load.user_id, load.org_id, payload)
+        return items_response(payload)
+
+    @app.get(f'/integrations/{provider.name}/items')
+    async def search_items(
+        user_id: str, org_id: str, q: str = None, prefix: str = None, type: str = None, parent_id: str = None,
+        modified_after: datetime = None, modified_before: datetime = None, limit: int = 100, offset: int = 0,
+    ):
+        """Search the items indexed by earlier loads that named this user_id and org_id."""
+        return items_response(await query_items(
+            provider.name, user_id, org_id, q=q, prefix=prefix, item_type=type, parent_id=parent_id,
+            modified_after=modified_after, modified_before=modified_before, limit=limit, offset=offset,
+        ))
+
+    @app.get(f'/integrations/{provider.name}/tree')
+    async def get_item_tree(user_id: str, org_id: str, node_id: str = None, node_type: str = None, limit: int = 100, offset: int = 0):
+        """One level of the indexed item tree: the roots, or the children of `node_id` (of `node_type`)."""
+        return items_response(await get_tree_level(provider.name, user_id, org_id, node_id, node_type, limit, offset))
+
+    @app.delete(f'/integrations/{provider.name}/items')
+    async def clear_items(user_id: str, org_id: str):
+        await clear_index(provider.name, user_id, org_id)
+        return {'cleared': True}
+
+    if provider.webhooks:
+        @app.post(f'/integrations/{provider.name}/webhooks')
+        async def subscribe_webhooks(user_id: str = Form(...), org_id: str = Form(...)):
+            return await provider.subscribe_webhooks(user_id, org_id)
+
+        @app.post(f'/integrations/{provider.name}/webhooks/events')
+        async def receive_webhook(request: Request):
+            return await provider.receive_webhook(request)
+
+for provider in PROVIDERS.values():
+    add_provider_routes(provider)
+
+# Aggregate load across providers
+AGGREGATE_LOAD_DEADLINE = float(os.environ.get('AGGREGATE_LOAD_DEADLINE', 30))
+
+def provider_credentials(provider, credentials):
+    """Credentials in the shape the provider's loaders take: a JSON string for form providers, a dict for JSON ones."""
+    if provider.credentials_format == 'json':
+        return json.loads(credentials) if isinstance(credentials, str) else credentials
+    return credentials if isinstance(credentials, str) else json.dumps(credentials)
 
-# Airtable
-@app.post('/integrations/airtable/authorize')
-async def authorize_airtable_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_airtable(user_id, org_id)
+def aggregate_loads(credentials):
+    """Provider name -> credentials in that provider's shape, rejecting unknown providers."""
+    loads = {}
+    for name, provider_creds in credentials.items():
+        if name not in PROVIDERS:
+            raise HTTPException(status_code=400, detail=f'Unknown integration: {name}')
+        loads[name] = provider_credentials(PROVIDERS[name], provider_creds)
+    if not loads:
+        raise HTTPException(status_code=400, detail='No provider credentials given.')
+    return loads
 
-@app.get('/integrations/airtable/oauth2callback')
-async def oauth2callback_airtable_integration(request: Request):
-    return await oauth2callback_airtable(request)
+async def load_one(provider, credentials, refresh, deadline):
+    """(items, meta, error) for one provider; a provider past its deadline only contributes an error."""
+    try:
+        payload = orjson.loads(await asyncio.wait_for(
+            cached_provider_load(provider, credentials, dict(provider.load_options), refresh),
+            timeout=deadline,
+        ))
+    except asyncio.TimeoutError:
+        # The shared load keeps running and fills the cache for the next request
+        return None, None, f'Timed out after {deadline:g}s'
+    except Exception as e:
+        logger.warning('Aggregate load of %s failed: %s', provider.name, load_error(e))
+        return None, None, load_error(e)
+    if isinstance(payload, dict):
+        if 'error' in payload:
+            return None, None, payload['error']
+        items = payload.pop('items', [])
+        payload.pop('count', None)
+        return items, payload, None
+    return payload, None, None
 
-@app.post('/integrations/airtable/credentials')
-async def get_airtable_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_airtable_credentials(user_id, org_id)
+def aggregate_ndjson_response(loads, deadline):
+    """Interleave every provider's pages as they arrive; each line is {"provider", "item"} or {"provider", "error"}."""
+    async def lines():
+        pages = asyncio.Queue(maxsize=2 * len(loads))
 
-@app.post('/integrations/airtable/load')
-async def get_airtable_items(credentials: str = Form(...)):
-    return await get_items_airtable(credentials)
+        async def pump(provider, credentials):
+            async for items in provider.iter_items(credentials, **provider.load_options):
+                if items:
+                    prefix = b'{"provider":"' + provider.name.encode('utf-8') + b'","item":'
+                    await pages.put(b''.join(prefix + item.to_json() + b'}\n' for item in items))
 
+        async def run(provider, credentials):
+            try:
+                await asyncio.wait_for(pump(provider, credentials), timeout=deadline)
+            except asyncio.TimeoutError:
+                await pages.put(encode_items({'provider': provider.name, 'error': f'Timed out after {deadline:g}s'}) + b'\n')
+            except Exception as e:
+                logger.warning('Aggregate stream of %s failed: %s', provider.name, load_error(e))
+                await pages.put(encode_items({'provider': provider.name, 'error': load_error(e)}) + b'\n')
+            await pages.put(None)
 
-# Notion
-@app.post('/integrations/notion/authorize')
-async def authorize_notion_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_notion(user_id, org_id)
+        runs = [asyncio.ensure_future(run(PROVIDERS[name], credentials)) for name, credentials in loads.items()]
+        try:
+            remaining = len(runs)
+            while remaining:
+                chunk = await pages.get()
+                if chunk is None:
+                    remaining -= 1
+                else:
+                    yield chunk
+        finally:
+            for task in runs:
+                task.cancel()
 
-@app.get('/integrations/notion/oauth2callback')
-async def oauth2callback_notion_integration(request: Request):
-    return await oauth2callback_notion(request)
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
 
-@app.post('/integrations/notion/credentials')
-async def get_notion_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_notion_credentials(user_id, org_id)
+@app.post('/integrations/load')
+async def load_all_items(credentials: dict = Body(...), refresh: bool = False, deadline: float = None, stream: str = None):
+    """Load several providers at once; `credentials` maps provider name to that provider's credentials.
 
-@app.post('/integrations/notion/load')
-async def get_notion_items(credentials: str = Form(...)):
-    return await get_items_notion(credentials)
+    Every provider gets `deadline` seconds (default AGGREGATE_LOAD_DEADLINE). Providers that
+    fail or run out of time are reported under `errors` while the others' items are returned.
+    """
+    loads = aggregate_loads(credentials)
+    deadline = deadline or AGGREGATE_LOAD_DEADLINE
+    if check_stream_mode(stream, ('ndjson',)):
+        return aggregate_ndjson_response(loads, deadline)
 
-# HubSpot
-@app.post('/integrations/hubspot/authorize')
-async def authorize_hubspot_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_hubspot(user_id, org_id)
+    results = await asyncio.gather(
+        *(load_one(PROVIDERS[name], creds, refresh, deadline) for name, creds in loads.items())
+    )
+    response = {'items': {}, 'meta': {}, 'errors': {}}
+    for name, (items, meta, error) in zip(loads, results):
+        if error is not None:
+            response['errors'][name] = error
+            continue
+        response['items'][name] = items
+        if meta:
+            response['meta'][name] = meta
+    response['partial'] = bool(response['errors'])
+    return Response(content=orjson.dumps(response), media_type='application/json')
 
-@app.get('/integrations/hubspot/oauth2callback')
-async def oauth2callback_hubspot_integration(request: Request):
-    return await oauth2callback_hubspot(request)
+# Item cache
+@app.post('/integrations/{provider}/cache/invalidate')
+async def invalidate_items_cache(provider: str, credentials: str = Form(...)):
+    await invalidate_cache(get_provider(provider).name, credentials)
+    return {'invalidated': True}
 
-@app.post('/integrations/hubspot/credentials')
-async def get_hubspot_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_hubspot_credentials(user_id, org_id)
+# Background load jobs
+@app.get('/jobs/{job_id}')
+async def get_load_job(job_id: str):
+    from jobs import get_job
+    return await get_job(job_id)
 
-@app.post('/integrations/hubspot/load')
-async def get_hubspot_items(credentials: dict = Body(...)):
-    print("Received request to load HubSpot items")
-    result = await get_items_hubspot(credentials)
-    return result
+@app.get('/jobs/{job_id}/results')
+async def get_load_job_results(job_id: str, chunk: int = 0):
+    from jobs import get_job_results
+    payload, job = await get_job_results(job_id, chunk)
+    response = items_response(payload)
+    response.headers['X-Job-Status'] = job['status']
+    response.headers['X-Job-Chunks'] = str(job['chunks'])
+    return response
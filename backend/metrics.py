@@ -0,0 +1,91 @@
+import os
+import time
+import functools
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+# Provider label for upstream hosts; anything else is reported under its host name
+PROVIDER_HOSTS = {
+    'api.airtable.com': 'airtable',
+    'airtable.com': 'airtable',
+    'api.notion.com': 'notion',
+    'api.hubapi.com': 'hubspot',
+}
+# Item conversion takes microseconds, far below the default buckets
+CONVERSION_BUCKETS = (1e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 1e-2)
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+ROUTE_REQUESTS = Counter('http_requests_total', 'API requests handled', ['method', 'route', 'status'])
+ROUTE_LATENCY = Histogram('http_request_duration_seconds', 'API request latency', ['method', 'route'])
+
+UPSTREAM_REQUESTS = Counter('upstream_requests_total', 'Requests sent to integration providers', ['provider', 'endpoint', 'status'])
+UPSTREAM_LATENCY = Histogram('upstream_request_duration_seconds', 'Provider response latency, per attempt', ['provider', 'endpoint'])
+UPSTREAM_RETRIES = Counter('upstream_retries_total', 'Provider requests retried', ['provider', 'endpoint', 'reason'])
+UPSTREAM_RESPONSE_BYTES = Counter('upstream_response_bytes_total', 'Response body bytes received from providers', ['provider', 'endpoint'])
+
+REDIS_OPERATIONS = Histogram('redis_operation_duration_seconds', 'Redis helper latency', ['operation'], buckets=REDIS_BUCKETS)
+REDIS_ERRORS = Counter('redis_operation_errors_total', 'Redis helpers that raised', ['operation'])
+
+ITEM_CONVERSION = Histogram('item_conversion_duration_seconds', 'Time to build one IntegrationItem from a provider object', ['provider'], buckets=CONVERSION_BUCKETS)
+ITEM_BATCH_CONVERSION = Histogram('item_batch_conversion_duration_seconds', 'Time to build the IntegrationItems of one provider page', ['provider'], buckets=REDIS_BUCKETS)
+
+# outcome: buffered, rejected (bad signature), coalesced (merged into a pending event), applied, failed
+WEBHOOK_EVENTS = Counter('webhook_events_total', 'Provider webhook events by outcome', ['provider', 'outcome'])
+
+
+def upstream_labels(host, path):
+    """(provider, endpoint) labels, with ids in the path collapsed so label values stay bounded."""
+    segments = [
+        '{id}' if len(segment) >= 8 and any(character.isdigit() for character in segment) else segment
+        for segment in path.split('/')
+    ]
+    return PROVIDER_HOSTS.get(host, host), '/'.join(segments)
+
+
+def observe_redis(operation):
+    """Decorator timing an async Redis helper."""
+    def decorator(function):
+        histogram = REDIS_OPERATIONS.labels(operation)
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                REDIS_ERRORS.labels(operation).inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def observe_conversion(provider, batch=False):
+    """Decorator timing an item conversion function; `batch` for ones converting a whole page."""
+    def decorator(function):
+        histogram = (ITEM_BATCH_CONVERSION if batch else ITEM_CONVERSION).labels(provider)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    """(body, content type) for the /metrics endpoint.
+
+    With several worker processes, set PROMETHEUS_MULTIPROC_DIR so every worker's samples are merged.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,289 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import datetime
+from email.utils import parsedate_to_datetime
+from cachetools import LRUCache
+from redis.exceptions import RedisError
+
+from redis_client import register_script_redis
+
+# Provider host -> (requests per second, burst) allowed per access token
+TOKEN_RATE_LIMITS = {
+    'api.airtable.com': (50, 50),
+    'api.notion.com': (3, 3),
+    # 110 requests / 10s for OAuth apps; refined from the X-HubSpot-RateLimit-* headers as they arrive
+    'api.hubapi.com': (11, 11),
+}
+# Narrower limits on top of the per-token one
+AIRTABLE_BASE_RATE_LIMIT = (5, 5)
+HUBSPOT_SEARCH_RATE_LIMIT = (4, 4)
+# Seconds a provider locks out a token after a 429 when it sends no Retry-After
+THROTTLE_PENALTIES = {'api.airtable.com': 30}
+
+# 'redis' shares every bucket across workers and pods; 'local' keeps them per process
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'redis')
+# Tokens a worker takes from Redis per round trip, and how long it may sit on unused ones
+RATE_LIMIT_LEASE_SIZE = int(os.environ.get('RATE_LIMIT_LEASE_SIZE', 5))
+RATE_LIMIT_LEASE_TTL = float(os.environ.get('RATE_LIMIT_LEASE_TTL', 1))
+
+BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', 30))
+
+# Buckets live per access token; idle ones are evicted once there are too many
+_buckets = LRUCache(maxsize=int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', 10000)))
+
+
+class TokenBucket:
+    """Token bucket that callers wait on before each upstream request."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # Holding the lock while sleeping keeps waiters in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429."""
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.blocked_until = max(self.blocked_until, self.updated + seconds)
+        return None
+
+    def update(self, rate=None, capacity=None, remaining=None):
+        """Adopt limits reported by the provider."""
+        self._refill(time.monotonic())
+        if rate:
+            self.rate = rate
+        if capacity:
+            self.capacity = capacity
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+        return None
+
+
+# Redis holds each bucket as a hash {tokens, updated, blocked_until}; time comes from the Redis
+# server so every worker refills against the same clock
+_TAKE_TOKENS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'blocked_until')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+local blocked_until = tonumber(state[3]) or 0
+if now < blocked_until then
+    return {0, tostring(blocked_until - now)}
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+_LIMIT_TOKENS_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local limit = tonumber(ARGV[1])
+if tokens == nil or tokens > limit then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(limit), 'updated', tostring(now))
+end
+local pause = tonumber(ARGV[2])
+if pause > 0 then
+    local blocked_until = tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0
+    redis.call('HSET', KEYS[1], 'blocked_until', tostring(math.max(blocked_until, now + pause)))
+end
+redis.call('EXPIRE', KEYS[1], math.ceil(pause) + 60)
+return 1
+"""
+
+_scripts = {}
+
+
+def _script(name, source):
+    if name not in _scripts:
+        _scripts[name] = register_script_redis(source)
+    return _scripts[name]
+
+
+class DistributedTokenBucket:
+    """Token bucket kept in Redis so every worker draws on one shared quota.
+
+    Tokens are leased a few at a time and spent locally, so most requests cost no Redis
+    round trip. If Redis is unreachable the bucket degrades to an in-process one.
+    """
+
+    def __init__(self, key, rate, capacity):
+        self.key = 'rate_limit:' + ':'.join(key)
+        self.local = TokenBucket(rate, capacity)
+        self.leased = 0
+        self.leased_at = 0.0
+        self.lock = asyncio.Lock()
+
+    @property
+    def rate(self):
+        return self.local.rate
+
+    @property
+    def capacity(self):
+        return self.local.capacity
+
+    def _lease_size(self):
+        # Never lease more than a quarter of the burst, so one worker can't starve the rest
+        return max(1, min(RATE_LIMIT_LEASE_SIZE, int(self.capacity // 4)))
+
+    async def acquire(self):
+        async with self.lock:
+            if time.monotonic() - self.leased_at > RATE_LIMIT_LEASE_TTL:
+                self.leased = 0
+            while self.leased < 1:
+                try:
+                    granted, wait = await _script('take', _TAKE_TOKENS_SCRIPT)(
+                        keys=[self.key], args=[self.rate, self.capacity, self._lease_size()]
+                    )
+                except RedisError:
+                    await self.local.acquire()
+                    return
+                self.leased = int(granted)
+                self.leased_at = time.monotonic()
+                if self.leased < 1:
+                    await asyncio.sleep(float(wait))
+            self.leased -= 1
+
+    async def limit(self, remaining=None, pause=0.0):
+        """Cap the shared tokens (and optionally block the bucket) for every worker."""
+        self.leased = 0
+        if pause:
+            self.local.pause(pause)
+        try:
+            await _script('limit', _LIMIT_TOKENS_SCRIPT)(
+                keys=[self.key], args=[self.capacity if remaining is None else remaining, pause]
+            )
+        except RedisError:
+            pass
+
+    def pause(self, seconds):
+        return self.limit(remaining=0, pause=seconds)
+
+    def update(self, rate=None, capacity=None, remaining=None):
+        self.local.update(rate, capacity, remaining)
+        # Only spend a Redis round trip once the provider says the quota is nearly gone
+        if remaining is not None and remaining < self.capacity:
+            return self.limit(remaining=remaining)
+        return None
+
+
+def _bucket(key, limit):
+    bucket = _buckets.get(key)
+    if bucket is None:
+        if RATE_LIMIT_BACKEND == 'redis':
+            bucket = DistributedTokenBucket(key, *limit)
+        else:
+            bucket = TokenBucket(*limit)
+        _buckets[key] = bucket
+    return bucket
+
+
+def _token_id(headers):
+    authorization = (headers or {}).get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    return hashlib.sha256(authorization[len('Bearer '):].encode('utf-8')).hexdigest()[:32]
+
+
+def buckets_for(host, path, headers):
+    """Every bucket a request must take a token from, broadest first; empty for unlimited hosts."""
+    limit = TOKEN_RATE_LIMITS.get(host)
+    token = _token_id(headers)
+    if limit is None or token is None:
+        return []
+
+    buckets = [_bucket((host, token), limit)]
+    if host == 'api.airtable.com':
+        base_id = next((segment for segment in path.split('/') if segment.startswith('app')), None)
+        if base_id:
+            buckets.append(_bucket((host, token, base_id), AIRTABLE_BASE_RATE_LIMIT))
+    elif host == 'api.hubapi.com' and path.endswith('/search'):
+        buckets.append(_bucket((host, token, 'search'), HUBSPOT_SEARCH_RATE_LIMIT))
+    return buckets
+
+
+async def acquire(buckets):
+    for bucket in buckets:
+        await bucket.acquire()
+
+
+async def observe(buckets, response):
+    """Tune the per-token bucket from HubSpot's rate limit headers."""
+    if not buckets or 'X-HubSpot-RateLimit-Max' not in response.headers:
+        return
+    try:
+        maximum = int(response.headers['X-HubSpot-RateLimit-Max'])
+        interval = int(response.headers.get('X-HubSpot-RateLimit-Interval-Milliseconds', 10000)) / 1000
+        remaining = int(response.headers.get('X-HubSpot-RateLimit-Remaining', maximum))
+    except ValueError:
+        return
+    shared_update = buckets[0].update(rate=maximum / interval, capacity=max(maximum / interval, 1), remaining=remaining)
+    if shared_update is not None:
+        await shared_update
+
+
+async def pause(buckets, seconds):
+    for bucket in buckets:
+        shared_pause = bucket.pause(seconds)
+        if shared_pause is not None:
+            await shared_pause
+
+
+def retry_after(response):
+    """Seconds the provider asked us to wait, from Retry-After (seconds or HTTP date)."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        if response.status_code == 429:
+            return THROTTLE_PENALTIES.get(response.request.url.host)
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+def backoff(attempt):
+    """Full-jitter exponential backoff delay for a retry attempt (0-based)."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
@@ -1,17 +1,113 @@
 import os
 import redis.asyncio as redis
+from redis.asyncio.connection import HIREDIS_AVAILABLE, HiredisParser, PythonParser
 from kombu.utils.url import safequote
 
+from metrics import observe_redis
+
 redis_host = safequote(os.environ.get('REDIS_HOST', 'localhost'))
-redis_client = redis.Redis(host=redis_host, port=6379, db=0)
+redis_port = int(os.environ.get('REDIS_PORT', 6379))
+redis_db = int(os.environ.get('REDIS_DB', 0))
+
+# Requests wait up to REDIS_POOL_TIMEOUT for a free connection instead of failing when the pool is busy
+redis_pool = redis.BlockingConnectionPool(
+    host=redis_host,
+    port=redis_port,
+    db=redis_db,
+    max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+    timeout=float(os.environ.get('REDIS_POOL_TIMEOUT', 5)),
+    socket_timeout=float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5)),
+    socket_connect_timeout=float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2)),
+    health_check_interval=30,
+    parser_class=HiredisParser if HIREDIS_AVAILABLE else PythonParser,
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
 
+@observe_redis('set')
 async def add_key_value_redis(key, value, expire=None):
-    await redis_client.set(key, value)
-    if expire:
-        await redis_client.expire(key, expire)
+    await redis_client.set(key, value, ex=expire)
 
+@observe_redis('get')
 async def get_value_redis(key):
     return await redis_client.get(key)
 
+@observe_redis('getdel')
+async def get_and_delete_value_redis(key):
+    """GETDEL: read a one-time value and remove it atomically."""
+    return await redis_client.getdel(key)
+
+@observe_redis('delete')
 async def delete_key_redis(key):
     await redis_client.delete(key)
+
+def pipeline_redis(transaction=True):
+    """Queue several commands and send them in one round trip with `await pipe.execute()`."""
+    return redis_client.pipeline(transaction=transaction)
+
+@observe_redis('set_many')
+async def add_key_values_redis(mapping, expire=None):
+    """SET ... EX for every key in `mapping`, in a single round trip."""
+    async with pipeline_redis() as pipe:
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=expire)
+        await pipe.execute()
+
+@observe_redis('getdel_many')
+async def get_and_delete_values_redis(*keys):
+    """GETDEL several keys atomically in a single round trip; values come back in key order."""
+    async with pipeline_redis() as pipe:
+        for key in keys:
+            pipe.getdel(key)
+        return await pipe.execute()
+
+@observe_redis('set_nx')
+async def add_key_value_if_absent_redis(key, value, expire):
+    """SET NX with expiry; returns True if this call created the key."""
+    return bool(await redis_client.set(key, value, ex=expire, nx=True))
+
+@observe_redis('delete_matching')
+async def delete_keys_matching_redis(pattern):
+    keys = [key async for key in redis_client.scan_iter(match=pattern)]
+    if keys:
+        await redis_client.delete(*keys)
+
+async def close_redis():
+    await redis_client.close()
+    await redis_pool.disconnect()
+
+def register_script_redis(script):
+    """Lua script callable as `await script(keys=[...], args=[...])`; sent once, then run by SHA."""
+    return redis_client.register_script(script)
+
+@observe_redis('hgetall')
+async def get_hash_redis(key):
+    return await redis_client.hgetall(key)
+
+@observe_redis('lpush')
+async def push_list_items_redis(key, values, max_length=None):
+    """LPUSH `values`, keeping only the newest `max_length` entries when given."""
+    async with pipeline_redis() as pipe:
+        pipe.lpush(key, *values)
+        if max_length:
+            pipe.ltrim(key, 0, max_length - 1)
+        await pipe.execute()
+
+@observe_redis('lindex')
+async def get_list_item_redis(key, index):
+    return await redis_client.lindex(key, index)
+
+@observe_redis('scan')
+async def get_keys_matching_redis(pattern):
+    return [key async for key in redis_client.scan_iter(match=pattern)]
+
+@observe_redis('sadd')
+async def add_set_member_redis(key, member, expire=None):
+    async with pipeline_redis() as pipe:
+        pipe.sadd(key, member)
+        if expire:
+            pipe.expire(key, expire)
+        await pipe.execute()
+
+@observe_redis('smembers')
+async def get_set_members_redis(key):
+    return await redis_client.smembers(key)
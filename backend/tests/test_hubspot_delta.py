@@ -0,0 +1,74 @@
+"""A HubSpot delta load may only move its watermark once it has returned every change since the last one."""
+import asyncio
+import datetime
+
+import httpx
+import orjson
+import pytest
+
+from integrations import hubspot
+
+SINCE = '2024-01-01T00:00:00+00:00'
+CHANGED = 150
+
+
+def _changed_record(index):
+    # Spread out, so every search window fits in one page and the budget runs out without a cursor pending
+    modified = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc) + datetime.timedelta(days=5 * index)
+    return {'id': str(index), 'properties': {'firstname': f'Contact {index}'}, 'updatedAt': modified.isoformat()}
+
+
+@pytest.fixture
+def watermarks(monkeypatch):
+    """The saved watermarks by account, starting from SINCE, with HubSpot answering from CHANGED contacts."""
+    saved = {('u', 'o'): {'since': SINCE}}
+    records = [_changed_record(index) for index in range(CHANGED)]
+
+    async def get_watermark(provider, user_id, org_id):
+        return saved.get((user_id, org_id))
+
+    async def save_watermark(provider, user_id, org_id, watermark):
+        saved[(user_id, org_id)] = watermark
+
+    async def post(url, json=None, **kwargs):
+        # CRM search: the records modified within the window, paged by offset. Yielding first lets
+        # the parallel windows all be in flight before any of them spends the budget, as over a network.
+        await asyncio.sleep(0)
+        window = json['filterGroups'][0]['filters'][0]
+        low, high = int(window['value']), int(window['highValue'])
+        matches = [record for record in records if low <= hubspot._parse_hubspot_ms(record['updatedAt']) <= high]
+        start = int(json.get('after') or 0)
+        body = {'total': len(matches), 'results': matches[start:start + json['limit']]}
+        if start + json['limit'] < len(matches):
+            body['paging'] = {'next': {'after': str(start + json['limit'])}}
+        return httpx.Response(200, content=orjson.dumps(body))
+
+    async def get(url, **kwargs):
+        # Nothing archived
+        return httpx.Response(200, content=orjson.dumps({'results': []}))
+
+    monkeypatch.setattr(hubspot, 'get_watermark', get_watermark)
+    monkeypatch.setattr(hubspot, 'save_watermark', save_watermark)
+    monkeypatch.setattr(hubspot.http_client, 'post', post)
+    monkeypatch.setattr(hubspot.http_client, 'get', get)
+    return saved
+
+
+def delta_load(max_items):
+    return asyncio.run(hubspot.get_delta_items_hubspot({'access_token': 'token'}, 'u', 'o', ['contacts'], max_items=max_items))
+
+
+def test_truncated_delta_keeps_watermark(watermarks):
+    result = delta_load(max_items=100)
+
+    assert result['truncated']
+    assert result['count'] == 100
+    assert watermarks[('u', 'o')] == {'since': SINCE}
+
+
+def test_complete_delta_moves_watermark(watermarks):
+    result = delta_load(max_items=1000)
+
+    assert not result['truncated']
+    assert result['count'] == CHANGED
+    assert watermarks[('u', 'o')] == {'since': _changed_record(CHANGED - 1)['updatedAt']}
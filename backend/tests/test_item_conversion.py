@@ -0,0 +1,96 @@
+"""The batch converters must build the same IntegrationItems as the per-record path."""
+import pytest
+
+from integrations import airtable, hubspot, notion
+
+MALFORMED_TIMESTAMPS = [None, '', 'not-a-date', '2024-13-45T00:00:00Z', '2024-01-02T03:04:05.678Z', '2024-01-02T03:04:05+02:00']
+
+
+def assert_same_items(records, per_record, batch):
+    assert batch(records) == [per_record(record) for record in records]
+
+
+def assert_same_failure(records, per_record, batch):
+    with pytest.raises(Exception) as batch_error:
+        batch(records)
+    with pytest.raises(Exception) as record_error:
+        for record in records:
+            per_record(record)
+    assert type(batch_error.value) is type(record_error.value)
+
+
+@pytest.mark.parametrize('object_type', list(hubspot.HUBSPOT_OBJECT_TYPES))
+def test_hubspot_batch_matches_per_record(object_type):
+    item_type = hubspot.HUBSPOT_OBJECT_TYPES[object_type][0]
+    records = [
+        {'id': '1', 'properties': {'firstname': 'Ada', 'lastname': 'Lovelace', 'hs_object_id': '1'},
+         'createdAt': '2024-01-01T00:00:00Z', 'updatedAt': '2024-01-02T00:00:00.123Z'},
+        {'id': '2', 'properties': {'dealname': 'Renewal'}},
+        {'id': '3', 'properties': {'name': 'Acme', 'hs_object_id': '3'}},
+        {'id': '4', 'properties': {'subject': 'Broken login'}},
+        {'id': '5', 'properties': {}},
+        {'id': '6'},
+        # Malformed records fall back to a placeholder item on both paths
+        {'id': '7', 'properties': None},
+        {'properties': {'firstname': 'No id'}},
+        {'id': '8', 'properties': {'firstname': 'Int'}, 'createdAt': 1704067200000},
+        {'id': '9', 'properties': {'firstname': 'List'}, 'updatedAt': ['2024-01-01T00:00:00Z']},
+    ]
+    records += [
+        {'id': f't{index}', 'properties': {'firstname': 'Time'}, 'createdAt': value, 'updatedAt': value}
+        for index, value in enumerate(MALFORMED_TIMESTAMPS)
+    ]
+    # The per-record path reads the type from the record; list pages are of a single type
+    for record in records:
+        record['objectType'] = item_type
+
+    assert_same_items(records, hubspot.create_integration_item_metadata_object,
+                      lambda page: hubspot.create_integration_items(page, item_type))
+
+
+def test_notion_batch_matches_per_record():
+    records = [
+        {'id': 'p1', 'object': 'page', 'url': 'https://notion.so/p1', 'parent': {'type': 'workspace', 'workspace': True},
+         'properties': {'title': {'title': [{'text': {'content': 'Roadmap'}}]}},
+         'created_time': '2024-01-01T00:00:00.000Z', 'last_edited_time': '2024-01-02T00:00:00.000Z'},
+        {'id': 'p2', 'object': 'page', 'parent': {'type': 'page_id', 'page_id': 'p1'},
+         'properties': {}, 'title': [{'text': {'content': 'From the body'}}]},
+        {'id': 'd1', 'object': 'database', 'parent': {'type': 'database_id', 'database_id': 'db'}},
+        {'id': 'p3', 'object': 'page'},
+    ]
+    records += [
+        {'id': f't{index}', 'object': 'page', 'created_time': value, 'last_edited_time': value}
+        for index, value in enumerate(MALFORMED_TIMESTAMPS)
+    ]
+    assert_same_items(records, notion.create_integration_item_metadata_object, notion.create_integration_items)
+
+
+@pytest.mark.parametrize('record', [
+    {'object': 'page'},
+    {'id': 'p1'},
+    {'id': 'p1', 'object': 'page', 'last_edited_time': 1704067200000},
+])
+def test_notion_malformed_records_fail_alike(record):
+    assert_same_failure([record], notion.create_integration_item_metadata_object, notion.create_integration_items)
+
+
+@pytest.mark.parametrize('item_type, parent_id, parent_name', [('Base', None, None), ('Table', 'b1', 'Base one')])
+def test_airtable_batch_matches_per_record(item_type, parent_id, parent_name):
+    records = [
+        {'id': 'a1', 'name': 'One', 'fields': [{'name': 'Status', 'type': 'singleSelect'}]},
+        {'id': 'a2'},
+        {'id': 'a3', 'name': None, 'permissionLevel': 'create'},
+    ]
+    assert_same_items(
+        records,
+        lambda record: airtable.create_integration_item_metadata_object(record, item_type, parent_id, parent_name),
+        lambda page: airtable.create_integration_items(page, item_type, parent_id, parent_name),
+    )
+
+
+def test_airtable_malformed_records_fail_alike():
+    assert_same_failure(
+        [{'name': 'No id'}],
+        lambda record: airtable.create_integration_item_metadata_object(record, 'Table'),
+        lambda page: airtable.create_integration_items(page, 'Table'),
+    )
@@ -0,0 +1,185 @@
+"""Push-based updates: provider webhook events are buffered in Redis, coalesced and applied.
+
+Receivers (receive_webhook_<name> in the provider modules) verify signatures and buffer one
+entry per changed object. A burst of events for the same object within
+WEBHOOK_COALESCE_WINDOW collapses into the latest one. The worker started with the app then
+claims due entries and hands them to apply_webhook_events_<name>, which fetches only the
+changed records and applies them to the item cache and index via apply_item_changes. A batch
+that fails is retried, and events that keep failing are moved to a dead-letter list.
+Providers also buffer delayed entries of their own for upkeep, such as Airtable's webhook refreshes.
+"""
+import os
+import time
+import asyncio
+import logging
+
+import orjson
+
+import metrics
+from item_cache import patch_cache
+from item_index import index_items
+from integrations.integration_item import IntegrationItem, encode_items
+from integrations.registry import get_provider
+from redis_client import register_script_redis, push_list_items_redis
+
+logger = logging.getLogger(__name__)
+
+# Events for the same object arriving within this many seconds are applied once
+WEBHOOK_COALESCE_WINDOW = float(os.environ.get('WEBHOOK_COALESCE_WINDOW', 2))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', 1))
+# Entries claimed per worker pass
+WEBHOOK_CLAIM_BATCH = int(os.environ.get('WEBHOOK_CLAIM_BATCH', 500))
+# A failed application is retried after this long
+WEBHOOK_RETRY_DELAY = float(os.environ.get('WEBHOOK_RETRY_DELAY', 30))
+# Events that failed this many times are dead-lettered instead of retried
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 5))
+# Newest dead-lettered events kept for inspection
+WEBHOOK_DEAD_LETTER_MAX = int(os.environ.get('WEBHOOK_DEAD_LETTER_MAX', 1000))
+
+EVENTS_KEY = 'webhook_events'
+DUE_KEY = 'webhook_events:due'
+DEAD_LETTER_KEY = 'webhook_events:dead'
+
+# ARGV: due time, then (field, occurred_at, event) triples. Older events than the pending one
+# for a field are dropped, and the due time is only set by the first event of a burst.
+_BUFFER_SCRIPT = """
+local coalesced = 0
+for i = 2, #ARGV, 3 do
+    local field, occurred_at = ARGV[i], tonumber(ARGV[i + 1])
+    local pending = redis.call('HGET', KEYS[1], field)
+    if pending then
+        coalesced = coalesced + 1
+    end
+    if not pending or tonumber(string.match(pending, '^([^|]*)')) <= occurred_at then
+        redis.call('HSET', KEYS[1], field, ARGV[i + 1] .. '|' .. ARGV[i + 2])
+    end
+    redis.call('ZADD', KEYS[2], 'NX', ARGV[1], field)
+end
+return coalesced
+"""
+
+# Atomically takes up to ARGV[2] entries due by ARGV[1], so several workers never apply the same one
+_CLAIM_SCRIPT = """
+local fields = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local claimed = {}
+for _, field in ipairs(fields) do
+    redis.call('ZREM', KEYS[2], field)
+    local event = redis.call('HGET', KEYS[1], field)
+    redis.call('HDEL', KEYS[1], field)
+    if event then
+        table.insert(claimed, field)
+        table.insert(claimed, event)
+    end
+end
+return claimed
+"""
+
+_scripts = {}
+_worker = None
+
+
+def _script(name, source):
+    if name not in _scripts:
+        _scripts[name] = register_script_redis(source)
+    return _scripts[name]
+
+
+async def buffer_events(provider, events, delay=None):
+    """Queue (object key, occurred_at ms, event dict) triples for the worker.
+
+    The object key identifies what changed (e.g. portal, type and id); events sharing it are coalesced.
+    """
+    if not events:
+        return
+    due = time.time() + (WEBHOOK_COALESCE_WINDOW if delay is None else delay)
+    args = [due]
+    for key, occurred_at, event in events:
+        args += [f'{provider}|{key}', int(occurred_at or 0), orjson.dumps(event)]
+    coalesced = await _script('buffer', _BUFFER_SCRIPT)(keys=[EVENTS_KEY, DUE_KEY], args=args)
+    metrics.WEBHOOK_EVENTS.labels(provider, 'buffered').inc(len(events) - coalesced)
+    if coalesced:
+        metrics.WEBHOOK_EVENTS.labels(provider, 'coalesced').inc(coalesced)
+
+
+async def claim_due_events(limit=WEBHOOK_CLAIM_BATCH):
+    """provider -> [(object key, occurred_at ms, event dict)] for the entries due now."""
+    claimed = await _script('claim', _CLAIM_SCRIPT)(keys=[EVENTS_KEY, DUE_KEY], args=[time.time(), limit])
+    events = {}
+    for field, entry in zip(claimed[::2], claimed[1::2]):
+        provider, _, key = field.decode('utf-8').partition('|')
+        occurred_at, _, event = entry.partition(b'|')
+        events.setdefault(provider, []).append((key, int(occurred_at), orjson.loads(event)))
+    return events
+
+
+async def apply_item_changes(provider, user_id, org_id, credentials, upserts, deleted):
+    """Write changed IntegrationItems and deletions ((type, id) pairs) to an account's cached loads and index."""
+    await patch_cache(provider, credentials, upserts, deleted)
+    tombstones = [IntegrationItem(id=item_id, type=item_type, delta='deleted') for item_type, item_id in deleted]
+    await index_items(provider, user_id, org_id, encode_items(list(upserts) + tombstones), replace=False)
+
+
+async def retry_events(provider, events):
+    """Buffer failed events again after WEBHOOK_RETRY_DELAY, dead-lettering those out of attempts.
+
+    The attempt count travels in the event dict under "attempts".
+    """
+    retries = []
+    dead = []
+    for key, occurred_at, event in events:
+        event = {**event, 'attempts': event.get('attempts', 0) + 1}
+        if event['attempts'] >= WEBHOOK_MAX_ATTEMPTS:
+            dead.append(orjson.dumps({'provider': provider, 'key': key, 'occurred_at': occurred_at, 'event': event}))
+        else:
+            retries.append((key, occurred_at, event))
+    await buffer_events(provider, retries, delay=WEBHOOK_RETRY_DELAY)
+    if dead:
+        logger.error('Dead-lettering %d %s webhook events after %d attempts', len(dead), provider, WEBHOOK_MAX_ATTEMPTS)
+        await push_list_items_redis(DEAD_LETTER_KEY, dead, max_length=WEBHOOK_DEAD_LETTER_MAX)
+        metrics.WEBHOOK_EVENTS.labels(provider, 'dead_lettered').inc(len(dead))
+
+
+async def apply_due_events():
+    """Claim and apply one batch of due events; returns how many were claimed."""
+    claimed = await claim_due_events()
+    for provider_name, events in claimed.items():
+        try:
+            await get_provider(provider_name).apply_webhook_events(events)
+        except Exception:
+            logger.exception('Applying %s webhook events failed', provider_name)
+            metrics.WEBHOOK_EVENTS.labels(provider_name, 'failed').inc(len(events))
+            await retry_events(provider_name, events)
+        else:
+            metrics.WEBHOOK_EVENTS.labels(provider_name, 'applied').inc(len(events))
+    return sum(len(events) for events in claimed.values())
+
+
+async def run_webhook_worker():
+    """Apply buffered events until cancelled; a full batch is followed straight away by the next."""
+    while True:
+        try:
+            claimed = await apply_due_events()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Webhook worker pass failed')
+            claimed = 0
+        if claimed < WEBHOOK_CLAIM_BATCH:
+            await asyncio.sleep(WEBHOOK_POLL_INTERVAL)
+
+
+def start_webhook_worker():
+    global _worker
+    if _worker is None:
+        _worker = asyncio.ensure_future(run_webhook_worker())
+
+
+async def stop_webhook_worker():
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+        _worker = None